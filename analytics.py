@@ -0,0 +1,176 @@
+import numpy as np
+import threading
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+class Column:
+    """
+    NumPy array that grows by doubling its capacity, so that appending
+    a batch of results doesn't copy the whole history.
+    """
+
+    def __init__(self, dtype, capacity: int = 1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.data[:self.size]
+
+    def extend(self, values: List):
+        new_size = self.size + len(values)
+        if new_size > len(self.data):
+            data = np.empty(max(new_size, 2 * len(self.data)),
+                            dtype=self.data.dtype)
+            data[:self.size] = self.values
+            self.data = data
+        self.data[self.size:new_size] = values
+        self.size = new_size
+
+
+class ResultsAnalytics:
+    """
+    Keeps the results history in columns, one row per result (i.e. an
+    issue round) and one row per distinct vote value in a result, and
+    computes estimation statistics over them with NumPy. Vote values
+    that aren't numbers (t-shirt sizes, "?", "coffee") count for
+    consensus, but not for spread and drift.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.room_codes: Dict[str, int] = {}
+        self.issue_codes: Dict[Tuple, int] = {}
+        self.result_rooms = Column(np.int32)
+        self.result_issues = Column(np.int64)
+        self.result_rounds = Column(np.int32)
+        self.result_timestamps = Column(np.float64)
+        self.vote_results = Column(np.int64)
+        self.vote_values = Column(np.float64)
+        self.vote_counts = Column(np.int64)
+
+    @staticmethod
+    def parse_vote_value(vote_value: str) -> float:
+        try:
+            return float(vote_value)
+        except ValueError:
+            return np.nan
+
+    def add_records(self, records: List[Dict]):
+        rooms, issues, rounds, timestamps = [], [], [], []
+        vote_results, vote_values, vote_counts = [], [], []
+        with self.lock:
+            result_index = self.result_rooms.size
+            for record in records:
+                room_code = self.room_codes.setdefault(record['room_id'],
+                                                       len(self.room_codes))
+                # issues share titles, so the id tells them apart when
+                # recorded
+                issue_key = (record['room_id'], record.get('game_id', ''),
+                             record.get('issue_id') or record['title'])
+                issue_code = self.issue_codes.setdefault(
+                    issue_key, len(self.issue_codes))
+                rooms.append(room_code)
+                issues.append(issue_code)
+                rounds.append(record['round'])
+                timestamps.append(record['timestamp'])
+                for vote_value, vote_details in record['report'].items():
+                    vote_results.append(result_index)
+                    vote_values.append(self.parse_vote_value(vote_value))
+                    vote_counts.append(vote_details['vote_count'])
+                result_index += 1
+            self.result_rooms.extend(rooms)
+            self.result_issues.extend(issues)
+            self.result_rounds.extend(rounds)
+            self.result_timestamps.extend(timestamps)
+            self.vote_results.extend(vote_results)
+            self.vote_values.extend(vote_values)
+            self.vote_counts.extend(vote_counts)
+
+    def summary(self, room_id: Optional[str] = None,
+                since: Optional[float] = None) -> Dict:
+        with self.lock:
+            room_code = self.room_codes.get(room_id, -1) \
+                if room_id is not None else None
+            result_mask = np.ones(self.result_rooms.size, dtype=bool)
+            if room_code is not None:
+                result_mask &= self.result_rooms.values == room_code
+            if since is not None:
+                result_mask &= self.result_timestamps.values >= since
+            issues = self.result_issues.values[result_mask]
+            rounds = self.result_rounds.values[result_mask]
+            vote_mask = result_mask[self.vote_results.values]
+            # renumber the selected results 0..n-1, keeping their order
+            result_ids = np.cumsum(result_mask) - 1
+            vote_results = result_ids[self.vote_results.values[vote_mask]]
+            vote_values = self.vote_values.values[vote_mask]
+            vote_counts = self.vote_counts.values[vote_mask]
+        return self.compute_summary(issues, rounds, vote_results,
+                                    vote_values, vote_counts)
+
+    @staticmethod
+    def compute_summary(issues: np.ndarray, rounds: np.ndarray,
+                        vote_results: np.ndarray, vote_values: np.ndarray,
+                        vote_counts: np.ndarray) -> Dict:
+        results_count = len(issues)
+        summary = {'results': results_count,
+                   'votes': int(vote_counts.sum()),
+                   'issues': int(len(np.unique(issues)))}
+        if results_count == 0:
+            return summary
+
+        distinct_values = np.bincount(vote_results, minlength=results_count)
+        voted = distinct_values > 0
+        summary['consensus_rate'] = float(
+            np.mean(distinct_values[voted] == 1)) if voted.any() else None
+
+        # per result, over numeric votes only
+        numeric = ~np.isnan(vote_values)
+        numeric_results = vote_results[numeric]
+        numeric_values = vote_values[numeric]
+        numeric_counts = vote_counts[numeric]
+        vote_weights = np.bincount(numeric_results, weights=numeric_counts,
+                                   minlength=results_count)
+        weighted_sums = np.bincount(numeric_results,
+                                    weights=numeric_values * numeric_counts,
+                                    minlength=results_count)
+        has_numeric = vote_weights > 0
+        means = np.full(results_count, np.nan)
+        means[has_numeric] = weighted_sums[has_numeric] / \
+            vote_weights[has_numeric]
+        if has_numeric.any():
+            # the votes of a result are contiguous, so reduceat works on
+            # the first vote of every result
+            starts = np.flatnonzero(np.r_[True, numeric_results[1:] !=
+                                          numeric_results[:-1]])
+            spreads = np.maximum.reduceat(numeric_values, starts) - \
+                np.minimum.reduceat(numeric_values, starts)
+            summary['mean_vote_spread'] = float(spreads.mean())
+            summary['max_vote_spread'] = float(spreads.max())
+        else:
+            summary['mean_vote_spread'] = None
+            summary['max_vote_spread'] = None
+
+        # per issue, from its first and last voted round
+        order = np.lexsort((rounds, issues))
+        sorted_issues = issues[order]
+        firsts = np.flatnonzero(np.r_[True, sorted_issues[1:] !=
+                                      sorted_issues[:-1]])
+        lasts = np.r_[firsts[1:], len(order)] - 1
+        rounds_per_issue = rounds[order][lasts]
+        summary['mean_rounds'] = float(rounds_per_issue.mean())
+        summary['revote_rate'] = float(np.mean(rounds_per_issue > 1))
+        drifts = means[order][lasts] - means[order][firsts]
+        revoted = (lasts > firsts) & ~np.isnan(drifts)
+        if revoted.any():
+            summary['mean_estimate_drift'] = float(drifts[revoted].mean())
+            summary['mean_abs_estimate_drift'] = float(
+                np.abs(drifts[revoted]).mean())
+        else:
+            summary['mean_estimate_drift'] = None
+            summary['mean_abs_estimate_drift'] = None
+        return summary
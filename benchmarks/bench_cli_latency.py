@@ -0,0 +1,72 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from delta_cli import MyPrompt  # noqa: E402
+from delta_client.session import create_session  # noqa: E402
+
+CONFIG = MyPrompt.default_config_params
+TIMEOUT = (CONFIG['connect_timeout'], CONFIG['read_timeout'])
+
+
+def measure(send, url, requests_count):
+    latencies = []
+    for _ in range(requests_count):
+        start_time = time.perf_counter()
+        response = send(method='get', url=url, timeout=TIMEOUT)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def summarize(latencies):
+    return {
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'max_ms': max(latencies) * 1000
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare per-command latency of a new connection per "
+                    "request with a pooled keep-alive session")
+    parser.add_argument("-n", "--requests", type=int, default=200,
+                        help="Number of requests per mode")
+    parser.add_argument("-r", "--route", type=str, default="/user/count",
+                        help="Route to query")
+    parser.add_argument("-u", "--url", type=str,
+                        default="http://localhost:8000",
+                        help="Poker server url")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Save results as JSON in this file")
+    args = parser.parse_args()
+
+    full_uri = ''.join([args.url, args.route])
+    results = {'no_session': summarize(
+        measure(requests.request, full_uri, args.requests))}
+    # the session the CLI configures, with its retrying adapter
+    with create_session(CONFIG['request_retries'],
+                        CONFIG['backoff_factor']) as session:
+        results['session'] = summarize(
+            measure(session.request, full_uri, args.requests))
+
+    for mode, summary in results.items():
+        print(f"{mode:>10}: mean {summary['mean_ms']:.2f} ms, "
+              f"p50 {summary['p50_ms']:.2f} ms, "
+              f"max {summary['max_ms']:.2f} ms")
+    reduction = 1 - results['session']['mean_ms'] / \
+        results['no_session']['mean_ms']
+    print(f"Mean latency reduction with a session: {reduction:.0%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
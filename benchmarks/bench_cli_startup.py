@@ -0,0 +1,78 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+SERVER_MODULES = ['fastapi', 'pydantic', 'starlette', 'uvicorn']
+CLI_START = ('from delta_cli import MyPrompt; '
+             'MyPrompt(**MyPrompt.default_config_params)')
+
+
+def measure_cold_start(runs):
+    # times interpreter start, the CLI imports and building the prompt,
+    # without running a command, which could send requests
+    durations = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', CLI_START],
+                       cwd=REPO_PATH, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def measure_interpreter(runs):
+    durations = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def find_server_modules():
+    output = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, delta_cli; print(" ".join(sys.modules))'],
+        cwd=REPO_PATH, capture_output=True, check=True).stdout.decode()
+    loaded_modules = set(output.split())
+    return [module for module in SERVER_MODULES if module in loaded_modules]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure the CLI cold start and fail when it is over "
+                    "budget or when it loads the server stack")
+    parser.add_argument("-b", "--budget-ms", type=float, default=150,
+                        help="Maximum median cold start, in milliseconds")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="Number of cold starts to measure")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Save results as JSON in this file")
+    args = parser.parse_args()
+
+    results = {
+        'interpreter_ms': statistics.median(
+            measure_interpreter(args.runs)) * 1000,
+        'cli_ms': statistics.median(measure_cold_start(args.runs)) * 1000,
+        'budget_ms': args.budget_ms,
+        'server_modules': find_server_modules()
+    }
+    print(f"Interpreter start: {results['interpreter_ms']:.1f} ms")
+    print(f"CLI cold start: {results['cli_ms']:.1f} ms "
+          f"(budget: {args.budget_ms:.0f} ms)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if results['server_modules']:
+        print(f"The CLI imports server modules: {results['server_modules']}")
+        sys.exit(1)
+    if results['cli_ms'] > args.budget_ms:
+        print("The CLI cold start is over budget")
+        sys.exit(1)
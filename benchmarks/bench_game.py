@@ -0,0 +1,197 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from game import Game  # noqa: E402
+from game import User  # noqa: E402
+from game import UserVote  # noqa: E402
+from game import VotingSystem  # noqa: E402
+
+VOTE_VALUES = VotingSystem.fibonacci.value
+
+
+def new_game(users_count, issues_count=1):
+    game = Game(VotingSystem.fibonacci.value)
+    usernames = [f"player{i}" for i in range(users_count)]
+    for username in usernames:
+        game.add_user(username)
+    game.add_issues([{'title': f"ISSUE {i}"} for i in range(issues_count)])
+    return game, usernames
+
+
+def user_votes(usernames):
+    return [UserVote(name=username,
+                     vote_value=VOTE_VALUES[i % len(VOTE_VALUES)])
+            for i, username in enumerate(usernames)]
+
+
+def vote_all(game, votes):
+    for user_vote in votes:
+        game.vote_issue(user_vote)
+
+
+def bench_vote_issue(users_count):
+    game, usernames = new_game(users_count)
+    votes = user_votes(usernames)
+    start_time = time.perf_counter()
+    vote_all(game, votes)
+    return time.perf_counter() - start_time, len(votes)
+
+
+def bench_vote_memory(users_count):
+    game, usernames = new_game(users_count)
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        # every UserVote is dropped after its vote, as after a request,
+        # so only what the game keeps is counted
+        vote_all(game, user_votes(usernames))
+        end_size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return end_size - start_size, len(usernames)
+
+
+def bench_left_to_vote(users_count, calls):
+    game, usernames = new_game(users_count)
+    vote_all(game, user_votes(usernames[:users_count // 2]))
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        game.left_to_vote()
+    return time.perf_counter() - start_time, calls
+
+
+def bench_aggregate_votes(users_count, calls):
+    game, usernames = new_game(users_count)
+    vote_all(game, user_votes(usernames))
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        game.aggregate_votes()
+    return time.perf_counter() - start_time, calls
+
+
+def bench_count_votes(users_count, calls):
+    game, usernames = new_game(users_count)
+    vote_all(game, user_votes(usernames))
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        game.count_votes()
+    return time.perf_counter() - start_time, calls
+
+
+def bench_reset_votes(users_count, calls):
+    game, usernames = new_game(users_count)
+    dealer = User(name=usernames[0])
+    votes = user_votes(usernames)
+    elapsed = 0
+    for _ in range(calls):
+        vote_all(game, votes)
+        start_time = time.perf_counter()
+        game.reset_votes(dealer)
+        elapsed += time.perf_counter() - start_time
+    return elapsed, calls
+
+
+def bench_add_issue(users_count, calls):
+    game, _ = new_game(users_count, issues_count=0)
+    start_time = time.perf_counter()
+    for i in range(calls):
+        game.add_issue(title=f"ISSUE {i}", description=f"Description {i}")
+    return time.perf_counter() - start_time, calls
+
+
+def run(users_count, calls, repeat):
+    benchmarks = {
+        'vote_issue': lambda: bench_vote_issue(users_count),
+        'left_to_vote': lambda: bench_left_to_vote(users_count, calls),
+        'aggregate_votes': lambda: bench_aggregate_votes(users_count, calls),
+        'count_votes': lambda: bench_count_votes(users_count, calls),
+        # every reset needs a full round of votes first, so fewer calls
+        'reset_votes': lambda: bench_reset_votes(users_count,
+                                                 max(1, calls // 200)),
+        'add_issue': lambda: bench_add_issue(users_count, calls)
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        # keep the best of `repeat` runs, the others are mostly noise
+        per_op = []
+        for _ in range(repeat):
+            elapsed, ops = benchmark()
+            per_op.append(elapsed / ops)
+        results[name] = {'us_per_op': min(per_op) * 10 ** 6, 'ops': ops}
+    memory, ops = bench_vote_memory(users_count)
+    results['vote_memory'] = {'bytes_per_op': memory / ops, 'ops': ops}
+    return results
+
+
+def get_metric(result):
+    return 'us_per_op' if 'us_per_op' in result else 'bytes_per_op'
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    print(f"{'benchmark':<16} {'users':>6} {'baseline':>12} "
+          f"{'current':>12} {'speedup':>8}")
+    for users_count, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            baseline_result = baseline.get(users_count, {}).get(name)
+            if baseline_result is None:
+                continue
+            metric = get_metric(result)
+            speedup = baseline_result[metric] / result[metric]
+            print(f"{name:<16} {users_count:>6} "
+                  f"{baseline_result[metric]:>12.2f} "
+                  f"{result[metric]:>12.2f} {speedup:>7.2f}x")
+            if speedup < 1 / (1 + max_regression):
+                regressions.append((name, users_count))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the Game hot paths, without HTTP, for growing "
+                    "numbers of users")
+    parser.add_argument("-u", "--users", type=int, nargs='+',
+                        default=[5, 50, 500, 5000],
+                        help="Numbers of users in the game")
+    parser.add_argument("-n", "--calls", type=int, default=1000,
+                        help="Number of calls per benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Number of runs per benchmark, the best is kept")
+    parser.add_argument("-b", "--baseline", type=str,
+                        help="Compare with results saved earlier with -o")
+    parser.add_argument("-m", "--max-regression", type=float, default=0.2,
+                        help="Fail when a benchmark is slower than the "
+                             "baseline by more than this fraction")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Save results as JSON in this file")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'benchmark':<16} {'users':>6} {'per_op':>12} unit")
+    for users_count in args.users:
+        # JSON object keys are strings, so are these, to compare with -b
+        results[str(users_count)] = run(users_count, args.calls,
+                                        args.repeat)
+        for name, result in results[str(users_count)].items():
+            metric = get_metric(result)
+            print(f"{name:<16} {users_count:>6} "
+                  f"{result[metric]:>12.2f} {metric[:-len('_per_op')]}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"Slower than the baseline: {regressions}")
+            sys.exit(1)
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from game import User  # noqa: E402
+from game import UserVote  # noqa: E402
+from persistence import StateStore  # noqa: E402
+from rooms import DEFAULT_ROOM_ID  # noqa: E402
+from rooms import RoomRegistry  # noqa: E402
+
+
+def play_session(registry, issues_count, users_count):
+    game = registry.get_room(DEFAULT_ROOM_ID)
+    usernames = [f"player{i}" for i in range(users_count)]
+    for username in usernames:
+        game.add_user(username)
+    for i in range(issues_count):
+        game.add_issue(title=f"ISSUE {i}", description=f"Description {i}")
+    dealer = User(name=usernames[0])
+    for _ in range(issues_count):
+        for username in usernames:
+            game.vote_issue(UserVote(name=username, vote_value="5"))
+        game.set_next_issue(dealer)
+
+
+def run(issues_count, users_count, snapshot_every):
+    with tempfile.TemporaryDirectory() as state_path:
+        registry = RoomRegistry()
+        state_store = StateStore(registry, path=state_path,
+                                 snapshot_every=snapshot_every)
+        state_store.recover()
+        start_time = time.perf_counter()
+        play_session(registry, issues_count, users_count)
+        play_time = time.perf_counter() - start_time
+        total_ops = state_store.seq
+        wal_size = os.path.getsize(state_store.wal_path)
+        snapshot_size = os.path.getsize(state_store.snapshot_path)
+        expected_snapshot = registry.to_snapshot()
+        state_store.wal_file.close()
+
+        restored_registry = RoomRegistry()
+        start_time = time.perf_counter()
+        replayed = StateStore(restored_registry, path=state_path,
+                              snapshot_every=snapshot_every).recover()
+        recovery_time = time.perf_counter() - start_time
+        if restored_registry.to_snapshot() != expected_snapshot:
+            raise RuntimeError("Recovered state differs from the original")
+
+    return {
+        'issues': issues_count,
+        'users': users_count,
+        'snapshot_every': snapshot_every,
+        'total_ops': total_ops,
+        'play_seconds': play_time,
+        'replayed_ops': replayed,
+        'wal_bytes': wal_size,
+        'snapshot_bytes': snapshot_size,
+        'recovery_seconds': recovery_time
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure restart recovery time from snapshot + WAL")
+    parser.add_argument("-i", "--issues", type=int, default=2000,
+                        help="Number of issues in the backlog")
+    parser.add_argument("-u", "--users", type=int, default=20,
+                        help="Number of players voting on every issue")
+    parser.add_argument("-s", "--snapshot-every", type=int, nargs='+',
+                        default=[100, 1000, 10000, 10 ** 9],
+                        help="Snapshot cadences (in operations) to compare")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Save results as JSON in this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'snapshot_every':>14} {'ops':>8} {'replayed':>8} "
+          f"{'wal_kb':>8} {'snap_kb':>8} {'recovery_s':>10}")
+    for snapshot_every in args.snapshot_every:
+        result = run(args.issues, args.users, snapshot_every)
+        results.append(result)
+        print(f"{snapshot_every:>14} {result['total_ops']:>8} "
+              f"{result['replayed_ops']:>8} "
+              f"{result['wal_bytes'] / 1024:>8.0f} "
+              f"{result['snapshot_bytes'] / 1024:>8.0f} "
+              f"{result['recovery_seconds']:>10.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
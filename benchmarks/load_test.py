@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from collections import defaultdict
+from pathlib import Path
+
+import requests
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+
+class RouteStats:
+    """
+    Collects request latencies per route from every player thread.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, route, latency, ok):
+        with self.lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    def summary(self, elapsed):
+        results = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            results[route] = {
+                'requests': len(latencies),
+                'errors': self.errors[route],
+                'throughput_rps': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000
+            }
+        return results
+
+
+def percentile(sorted_values, rank):
+    index = min(len(sorted_values) - 1,
+                int(round(rank / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def timed_request(session, stats, method, url, route, **kwargs):
+    start_time = time.perf_counter()
+    response = session.request(method=method, url=url + route, **kwargs)
+    stats.record(route, time.perf_counter() - start_time,
+                 response.status_code == requests.codes.ok)
+    return response
+
+
+def wait_for_report(session, stats, url, args):
+    version = None
+    while True:
+        params = {}
+        if args.long_poll and version is not None:
+            params = {'wait': 10, 'version': version}
+        response = timed_request(session, stats, 'get', url,
+                                 '/issue/show_results', params=params)
+        response_dict = response.json()
+        if response_dict['result_message']['status'] == 'done':
+            return
+        version = response_dict.get('version')
+        if not args.long_poll:
+            time.sleep(args.poll_interval)
+
+
+def play(url, room_id, player_index, barrier, stats, args):
+    username = f"player{player_index}"
+    with requests.Session() as session:
+        session.headers.update({'X-Room-Id': room_id})
+        timed_request(session, stats, 'post', url, '/user/add',
+                      json={'name': username})
+        barrier.wait()
+        response = timed_request(session, stats, 'get', url,
+                                 '/game/get_dealer')
+        is_dealer = \
+            response.json()['result_message']['current_dealer'] == username
+        for issue_index in range(args.issues):
+            for _ in range(args.revotes + 1):
+                timed_request(session, stats, 'put', url, '/issue/vote',
+                              json={'name': username, 'vote_value': '5'})
+                wait_for_report(session, stats, url, args)
+                barrier.wait()
+                if is_dealer:
+                    timed_request(session, stats, 'post', url,
+                                  '/issue/votes_reset',
+                                  json={'name': username})
+                barrier.wait()
+            if is_dealer:
+                timed_request(session, stats, 'post', url, '/issue/next',
+                              json={'name': username})
+            barrier.wait()
+
+
+def setup_room(url, room_id, issues_count):
+    with requests.Session() as session:
+        session.post(f"{url}/room/add",
+                     json={'room_id': room_id}).raise_for_status()
+        session.put(f"{url}/issue/add_bulk",
+                    headers={'X-Room-Id': room_id},
+                    json=[{'title': f"ISSUE {i}"}
+                          for i in range(issues_count)]).raise_for_status()
+
+
+def start_server(port, workers, data_path, state_backend):
+    env = dict(os.environ, DELTA_STATE_PATH=os.path.join(data_path, 'state'),
+               DELTA_RESULTS_PATH=os.path.join(data_path, 'results'),
+               DELTA_STATE_BACKEND=state_backend)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'delta_poker:app',
+         '--port', str(port), '--workers', str(workers),
+         '--log-level', 'warning'], cwd=REPO_PATH, env=env,
+        start_new_session=True)
+    url = f"http://localhost:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url)
+            return server, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    stop_server(server)
+    raise RuntimeError("The poker server didn't start")
+
+
+def stop_server(server):
+    # the uvicorn supervisor doesn't pass SIGTERM on to its workers
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+
+
+def run(url, args):
+    run_id = uuid.uuid4().hex[:8]
+    room_ids = [f"load-{run_id}-{i}" for i in range(args.rooms)]
+    for room_id in room_ids:
+        setup_room(url, room_id, args.issues)
+
+    stats = RouteStats()
+    threads = []
+    for room_id in room_ids:
+        barrier = threading.Barrier(args.players)
+        for player_index in range(args.players):
+            threads.append(threading.Thread(
+                target=play, args=(url, room_id, player_index, barrier,
+                                   stats, args)))
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    return elapsed, stats.summary(elapsed)
+
+
+def run_with_server(args, workers):
+    # workers only share rooms through the sqlite state store
+    state_backend = args.state_backend or \
+        ('sqlite' if workers > 1 else 'file')
+    server = None
+    with tempfile.TemporaryDirectory() as data_path:
+        if args.url:
+            url = args.url
+        else:
+            server, url = start_server(args.port, workers, data_path,
+                                       state_backend)
+        try:
+            return run(url, args)
+        finally:
+            if server is not None:
+                stop_server(server)
+
+
+def print_results(args, elapsed, results):
+    total_requests = sum(route['requests'] for route in results.values())
+    print(f"{args.rooms} rooms x {args.players} players, {args.issues} "
+          f"issues: {total_requests} requests in {elapsed:.2f}s "
+          f"({total_requests / elapsed:.0f} req/s)")
+    print(f"{'route':<22} {'requests':>8} {'errors':>6} {'req/s':>8} "
+          f"{'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8}")
+    for route, route_stats in results.items():
+        print(f"{route:<22} {route_stats['requests']:>8} "
+              f"{route_stats['errors']:>6} "
+              f"{route_stats['throughput_rps']:>8.0f} "
+              f"{route_stats['p50_ms']:>8.2f} {route_stats['p95_ms']:>8.2f} "
+              f"{route_stats['p99_ms']:>8.2f}")
+    return total_requests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Simulate rooms x players playing planning poker "
+                    "against a poker server")
+    parser.add_argument("-r", "--rooms", type=int, default=10,
+                        help="Number of rooms")
+    parser.add_argument("-p", "--players", type=int, default=8,
+                        help="Number of players per room")
+    parser.add_argument("-i", "--issues", type=int, default=5,
+                        help="Number of issues voted in every room")
+    parser.add_argument("--revotes", type=int, default=1,
+                        help="Number of votes_reset rounds per issue")
+    parser.add_argument("--poll-interval", type=float, default=0.05,
+                        help="Seconds between show_results polls")
+    parser.add_argument("--long-poll", action='store_true',
+                        help="Long-poll show_results instead of sleeping")
+    parser.add_argument("-u", "--url", type=str,
+                        help="Use a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port for the server started by this script")
+    parser.add_argument("-w", "--workers", type=int, nargs='+', default=[1],
+                        help="Number of uvicorn workers for that server; "
+                             "several numbers run the test once for each")
+    parser.add_argument("-s", "--state-backend", choices=['file', 'sqlite'],
+                        help="State store of that server, sqlite by default "
+                             "with several workers")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Save results as JSON in this file")
+    args = parser.parse_args()
+
+    runs = []
+    for workers in args.workers:
+        print(f"--- {workers} worker(s)")
+        elapsed, results = run_with_server(args, workers)
+        total_requests = print_results(args, elapsed, results)
+        runs.append({'workers': workers, 'elapsed_seconds': elapsed,
+                     'total_requests': total_requests, 'routes': results})
+
+    if len(runs) > 1:
+        base_throughput = runs[0]['total_requests'] / \
+            runs[0]['elapsed_seconds']
+        print(f"{'workers':>7} {'req/s':>8} {'speedup':>8}")
+        for worker_run in runs:
+            throughput = worker_run['total_requests'] / \
+                worker_run['elapsed_seconds']
+            print(f"{worker_run['workers']:>7} {throughput:>8.0f} "
+                  f"{throughput / base_throughput:>7.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'rooms': args.rooms, 'players': args.players,
+                       'issues': args.issues, 'runs': runs}, f, indent=4)
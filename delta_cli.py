@@ -1,19 +1,27 @@
 import argparse
 import json
-import requests
 import time
 
 from cmd import Cmd
-from fastapi import status
+from delta_client import status
+from delta_client.session import create_session
 from pathlib import Path
 
+MAX_BATCH_SIZE = 500
+
 
 class MyPrompt(Cmd):
     prompt = 'planning_poker> '
     intro = "Welcome to a nice game of Planning Poker!\nType ? to list commands"
 
-    default_config_params = {"max_retries": 5,
+    default_config_params = {"backoff_factor": 0.3,
+                             "connect_timeout": 3.05,
+                             "max_retries": 5,
+                             "read_timeout": 10,
+                             "request_retries": 3,
+                             "room": "default",
                              "show_timeout": 1,
+                             "state_ttl": 1,
                              "url": "http://localhost:8000"}
     default_keys_set = set(default_config_params.keys())
 
@@ -38,6 +46,18 @@ class MyPrompt(Cmd):
                 setattr(self, config_key,
                         self.default_config_params[config_key])
 
+        self._session = None
+        self._state = None
+        self._state_etag = None
+        self._state_time = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = create_session(self.request_retries,
+                                           self.backoff_factor)
+        return self._session
+
     def default(self, inp):
         """
         You can also use x or q to exit the game. All commands that are
@@ -53,6 +73,8 @@ class MyPrompt(Cmd):
     def print_error_response(response):
         if response.status_code == status.HTTP_400_BAD_REQUEST:
             print(f"{json.loads(response.text)['detail']}")
+        elif response.status_code == status.HTTP_404_NOT_FOUND:
+            print(f"{json.loads(response.text)['detail']}")
         elif response.status_code == status.HTTP_412_PRECONDITION_FAILED:
             print(f"{json.loads(response.text)['detail']}")
         elif response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY:
@@ -76,43 +98,243 @@ class MyPrompt(Cmd):
                   f"story points.\n"
                   f"{json.dumps(vote_details['voters'], indent=4)}\n")
 
+    @staticmethod
+    def iter_events(response):
+        # keepalive comments are yielded as (None, None), so that the
+        # caller gets to check its deadline while nothing happens
+        event_type, data_lines = None, []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if line.startswith(':'):
+                yield None, None
+                continue
+            if line == '':
+                if event_type is not None:
+                    yield event_type, json.loads('\n'.join(data_lines))
+                event_type, data_lines = None, []
+            elif line.startswith('event:'):
+                event_type = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                data_lines.append(line[len('data:'):].strip())
+
+    def show_results(self):
+        response = self.send_request(method='get',
+                                     route='/issue/show_results')
+        if response.status_code == status.HTTP_200_OK:
+            response_message = json.loads(response.text)['result_message']
+            if response_message['status'] == 'done':
+                self.parse_report(response_message['report'])
+            elif 'previous_issue' in response_message:
+                # consensus moved the game on before the report was shown
+                previous_issue = response_message['previous_issue']
+                print(f"'{previous_issue['title']}' reached consensus and "
+                      f"the game moved to the next issue.")
+                self.parse_report(previous_issue['report'])
+                response_message['status'] = 'done'
+            return response_message
+        self.print_error_response(response)
+        return {'status': 'error'}
+
     def get_report(self, inp):
-        current_status = 'pending'
-        retry_count = 0
-        while current_status == 'pending' and retry_count < self.max_retries:
-            response = self.send_request(method='get',
-                                         route='/issue/show_results')
-            if response.status_code == status.HTTP_200_OK:
-                response_message = json.loads(response.text)['result_message']
-                current_status = response_message['status']
-                if current_status == 'done':
-                    self.parse_report(response_message['report'])
-            else:
-                current_status = 'error'
-                self.print_error_response(response)
-            retry_count += 1
-            time.sleep(self.show_timeout)
+        from requests.exceptions import RequestException
+
+        wait_time = self.max_retries * self.show_timeout
+        deadline = time.monotonic() + wait_time
+        try:
+            # the server ends a stream at the deadline, and earlier when
+            # the room is replaced, after which it is opened again
+            while time.monotonic() < deadline:
+                time_left = deadline - time.monotonic()
+                with self.send_request(method='get', route='/game/events',
+                                       params={'wait': time_left}, stream=True,
+                                       timeout=(self.connect_timeout,
+                                                time_left)) as events:
+                    if events.status_code != status.HTTP_200_OK:
+                        self.print_error_response(events)
+                        return
+                    response_message = self.show_results()
+                    if response_message['status'] != 'pending':
+                        return
+                    for event_type, data in self.iter_events(events):
+                        if time.monotonic() > deadline:
+                            break
+                        if event_type == 'consensus':
+                            print(f"'{data['title']}' reached consensus on "
+                                  f"{data['estimate']} story points.")
+                            self.parse_report(data['report'])
+                            return
+                        if event_type == 'report':
+                            response_message = self.show_results()
+                            if response_message['status'] != 'pending':
+                                return
+        except RequestException:
+            pass
+        response_message = self.show_results()
+        if response_message['status'] == 'pending':
+            print(f"{response_message['report']}")
+
+    def get_state(self):
+        """
+        Returns the game state of the room, from the local cache while
+        it is younger than `state_ttl` seconds. After that, the server
+        is asked for it again and answers with 304 if it didn't change.
+        """
+        if self._state_time is not None and \
+                time.monotonic() - self._state_time < self.state_ttl:
+            return self._state
+        headers = None
+        if self._state is not None:
+            headers = {'If-None-Match': self._state_etag}
+        response = self.send_request(method='get', route='/game/state',
+                                     headers=headers)
+        if response.status_code == status.HTTP_304_NOT_MODIFIED:
+            self._state_time = time.monotonic()
+        elif response.status_code == status.HTTP_200_OK:
+            self._state = json.loads(response.text)['result_message']
+            self._state_etag = response.headers.get('ETag')
+            self._state_time = time.monotonic()
+        else:
+            self.print_error_response(response)
+            return None
+        return self._state
+
+    def invalidate_state(self, forget=False):
+        self._state_time = None
+        if forget:
+            self._state = None
+            self._state_etag = None
 
-    def send_request(self, method, route, params=None, data=None):
+    def send_request(self, method, route, params=None, data=None,
+                     stream=False, timeout=None, headers=None):
         full_uri = ''.join([self.url, route])
-        response = requests.request(method=method, url=full_uri,
-                                    params=params, json=data)
+        headers = {'X-Room-Id': self.room, **(headers or {})}
+        if method != 'get':
+            # the cached state is revalidated on its next use
+            self.invalidate_state()
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        response = self.session.request(method=method, url=full_uri,
+                                        params=params, json=data,
+                                        headers=headers, stream=stream,
+                                        timeout=timeout)
         return response
 
+    def get_operation(self, command, arg):
+        """
+        Returns the game operation for a script command that only
+        changes the game, which can run in a batch, and None for the
+        other commands
+        """
+        user = {'name': self.username}
+        if command == 'add_issues':
+            with open(arg) as f:
+                return {'op': 'add_issues', 'args': {'issues': json.load(f)}}
+        if command == 'add_player':
+            if self.username is None:
+                # the first player of a script plays the following commands
+                self.username = arg
+            return {'op': 'add_user', 'args': {'username': arg}}
+        if command == 'goto_issue' and arg.isdigit():
+            return {'op': 'goto_issue',
+                    'args': {'user': user, 'issue_id': int(arg)}}
+        if command == 'new_game':
+            return {'op': 'new_game', 'args': {'user': user}}
+        if command == 'next_issue':
+            return {'op': 'set_next_issue', 'args': {'user': user}}
+        if command == 'previous_issue':
+            return {'op': 'set_previous_issue', 'args': {'user': user}}
+        if command == 'remove_player':
+            return {'op': 'remove_player',
+                    'args': {'user': user, 'username': arg}}
+        if command == 'reset_votes':
+            return {'op': 'reset_votes', 'args': {'user': user}}
+        if command == 'vote_issue':
+            return {'op': 'vote_issue',
+                    'args': {'user_vote': {'name': self.username,
+                                           'vote_value': arg}}}
+        return None
+
+    def run_batch(self, lines, operations):
+        if len(operations) == 0:
+            return True
+        response = self.send_request(method='post', route='/game/batch',
+                                     data={'operations': operations})
+        if response.status_code == status.HTTP_200_OK:
+            results = json.loads(response.text)['result_message']['results']
+            for line, result in zip(lines, results):
+                print(f"{self.prompt}{line}")
+                if result is not None:
+                    print(f"{result}")
+            return True
+        self.print_error_response(response)
+        return False
+
+    def run_script(self, script_path):
+        """
+        Runs the commands of a file, one per line, without prompting.
+        Consecutive commands that only change the game are sent in a
+        single batch, applied at once by the server; any other command
+        first sends the pending batch and then runs as if typed. The
+        script stops at the first batch that fails.
+        """
+        lines, operations = [], []
+        with open(script_path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                command, _, arg = line.partition(' ')
+                try:
+                    operation = self.get_operation(command, arg.strip())
+                except (OSError, ValueError) as e:
+                    print(f"Couldn't run '{line}': {e}")
+                    return
+                if operation is not None:
+                    lines.append(line)
+                    operations.append(operation)
+                    if len(operations) == MAX_BATCH_SIZE:
+                        if not self.run_batch(lines, operations):
+                            return
+                        lines, operations = [], []
+                    continue
+                if not self.run_batch(lines, operations):
+                    return
+                lines, operations = [], []
+                print(f"{self.prompt}{line}")
+                if self.onecmd(line):
+                    return
+        self.run_batch(lines, operations)
+
+    def do_add_issues(self, issues_path):
+        """
+        Add the issues of a JSON file (a list of objects with a title
+        and a description) to the current game
+        """
+        try:
+            with open(issues_path) as f:
+                issues = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Couldn't read the issues from '{issues_path}': {e}")
+            return
+        response = self.send_request(method='put',
+                                     route='/issue/add_bulk',
+                                     data=issues)
+        if response.status_code == status.HTTP_200_OK:
+            response_dict = json.loads(response.text)
+            print(f"{response_dict['result_message']}")
+        else:
+            self.print_error_response(response)
+
     def do_add_player(self, username):
         """
         Add a player to the current game
         """
         current_players = []
-
-        response = self.send_request(method='get',
-                                     route='/user/show_all')
-
-        if response.status_code == status.HTTP_200_OK:
-            response_dict = json.loads(response.text)
-            current_players = response_dict['result_message']['current_users']
-        else:
-            self.print_error_response(response)
+        if self.username:
+            crt_state = self.get_state()
+            if crt_state is not None:
+                current_players = crt_state['current_users']
 
         if self.username and self.username in current_players:
             print(f"You already have a username in the current game: "
@@ -131,45 +353,133 @@ class MyPrompt(Cmd):
             else:
                 self.print_error_response(response)
 
-    def do_current_dealer(self, inp):
+    def do_add_room(self, room_id):
         """
-        Show current dealer
+        Add a new room, with its own game, on the server
         """
-        response = self.send_request(method='get',
-                                     route='/game/get_dealer')
+        crt_dict = {
+            'room_id': room_id
+        }
+        response = self.send_request(method='post',
+                                     route='/room/add',
+                                     data=crt_dict)
         if response.status_code == status.HTTP_200_OK:
             response_dict = json.loads(response.text)
-            print(f"Current dealer is "
-                  f"{response_dict['result_message']['current_dealer']}")
+            print(f"{response_dict['result_message']}")
         else:
             self.print_error_response(response)
 
-    def do_current_issue(self, inp):
+    def do_consensus(self, inp):
         """
-        Show issue that players are voting on now
+        Show how close the votes on the current issue are to consensus
         """
         response = self.send_request(method='get',
-                                     route='/issue/current')
+                                     route='/issue/consensus')
+        if response.status_code == status.HTTP_200_OK:
+            response_dict = json.loads(response.text)['result_message']
+            crt_issue = response_dict['issue']
+            if crt_issue['agreement'] is None:
+                print(f"Nobody voted on {crt_issue['title']} yet")
+            else:
+                print(f"{crt_issue['agreement']:.0%} voted for "
+                      f"{crt_issue['mode']} on {crt_issue['title']}, with "
+                      f"{crt_issue['spread']} cards between the lowest and "
+                      f"the highest vote")
+                if crt_issue.get('mode_tied'):
+                    print("Another card got as many votes, so there is no "
+                          "consensus")
+            if crt_issue['consensus'] is not None:
+                print(f"Consensus reached: {crt_issue['consensus']} story "
+                      f"points")
+        else:
+            self.print_error_response(response)
+
+    def do_consensus_policy(self, inp):
+        """
+        Set when the votes reach consensus (dealer only):
+        consensus_policy $min_agreement [$max_spread] [auto], where
+        `auto` moves to the next issue on consensus, or
+        consensus_policy off
+        """
+        args = inp.split()
+        if len(args) == 0:
+            print("Please give the minimum agreement (e.g. 0.8) or 'off'")
+            return
+        policy = {'enabled': args[0] != 'off'}
+        if policy['enabled']:
+            try:
+                policy['min_agreement'] = float(args[0])
+                if len(args) > 1 and args[1] != 'auto':
+                    policy['max_spread'] = int(args[1])
+            except ValueError:
+                print("Please use numbers for the minimum agreement and "
+                      "the maximum spread")
+                return
+            policy['auto_advance'] = 'auto' in args[1:]
+        crt_dict = {
+            'user': {'name': self.username},
+            'policy': policy
+        }
+        response = self.send_request(method='post',
+                                     route='/game/consensus_policy',
+                                     data=crt_dict)
         if response.status_code == status.HTTP_200_OK:
             response_dict = json.loads(response.text)
-            self.print_issue(response_dict)
+            print(f"Consensus policy: "
+                  f"{response_dict['result_message']['consensus_policy']}")
         else:
             self.print_error_response(response)
 
+    def do_current_dealer(self, inp):
+        """
+        Show current dealer
+        """
+        crt_state = self.get_state()
+        if crt_state is not None:
+            print(f"Current dealer is {crt_state['current_dealer']}")
+
+    def do_current_issue(self, inp):
+        """
+        Show issue that players are voting on now
+        """
+        crt_state = self.get_state()
+        if crt_state is None:
+            return
+        if crt_state['current_issue'] is None:
+            print("Please add issues to the game")
+        else:
+            self.print_issue({'result_message': crt_state['current_issue']})
+
     def do_current_players(self, inp):
         """
         Show players that are registered for the current game
         """
+        crt_state = self.get_state()
+        if crt_state is None:
+            return
+        current_users = crt_state['current_users']
+        if len(current_users) == 0:
+            print("Please add players to the game")
+        else:
+            print(f"Currently playing Planning Poker: "
+                  f"{json.dumps(current_users)}")
+
+    def do_current_room(self, inp):
+        """
+        Show room that this CLI is playing in
+        """
+        print(f"Currently playing in room '{self.room}'")
+
+    def do_current_rooms(self, inp):
+        """
+        Show rooms that are available on the server
+        """
         response = self.send_request(method='get',
-                                     route='/user/show_all')
+                                     route='/room/show_all')
         if response.status_code == status.HTTP_200_OK:
             response_dict = json.loads(response.text)
-            current_users = response_dict['result_message']['current_users']
-            if len(current_users) == 0:
-                print("Please add players to the game")
-            else:
-                print(f"Currently playing Planning Poker: "
-                      f"{json.dumps(current_users)}")
+            print(f"Available rooms: "
+                  f"{json.dumps(response_dict['result_message']['rooms'])}")
         else:
             self.print_error_response(response)
 
@@ -177,13 +487,13 @@ class MyPrompt(Cmd):
         """
         Show if all players voted or who still has to vote
         """
-        response = self.send_request(method='get',
-                                     route='/issue/vote_status')
-        if response.status_code == status.HTTP_200_OK:
-            response_dict = json.loads(response.text)
-            print(f"{response_dict['result_message']}")
+        crt_state = self.get_state()
+        if crt_state is None:
+            return
+        if crt_state['vote_status'] is None:
+            print("Please add issues to the game")
         else:
-            self.print_error_response(response)
+            print(f"{crt_state['vote_status']}")
 
     def do_exit(self):
         """
@@ -204,8 +514,70 @@ class MyPrompt(Cmd):
             self.print_error_response(response)
         print(f"Buh-bye, {self.username}! And in case I don't see you again, "
               f"good afternoon, good evening and good night!")
+        if self._session is not None:
+            self._session.close()
         return True
 
+    def do_goto_issue(self, issue_id):
+        """
+        Jump to the issue with the given id (see list_issues)
+        """
+        if not issue_id.isdigit():
+            print("Please give the id of the issue")
+            return
+        params_dict = {
+            'issue_id': int(issue_id)
+        }
+        crt_dict = {
+            'name': self.username
+        }
+        response = self.send_request(method='post',
+                                     route='/issue/goto',
+                                     params=params_dict,
+                                     data=crt_dict)
+        if response.status_code == status.HTTP_200_OK:
+            response_dict = json.loads(response.text)
+            self.print_issue(response_dict)
+        else:
+            self.print_error_response(response)
+
+    def do_join_room(self, room_id):
+        """
+        Switch to another room. Add a player again after joining it
+        """
+        if len(room_id) == 0:
+            print("Please give the name of the room")
+        else:
+            self.room = room_id
+            self.username = None
+            self.invalidate_state(forget=True)
+            print(f"Joined room '{self.room}'. Please add a player to play "
+                  f"in this room")
+
+    def do_list_issues(self, cursor):
+        """
+        List the issues of the current game, a page at a time. Give the
+        cursor printed at the end of a page to list the next one
+        """
+        params_dict = {}
+        if len(cursor) > 0:
+            params_dict['cursor'] = cursor
+        response = self.send_request(method='get',
+                                     route='/issue/list',
+                                     params=params_dict)
+        if response.status_code == status.HTTP_200_OK:
+            response_dict = json.loads(response.text)['result_message']
+            if len(response_dict['issues']) == 0:
+                print("Please add issues to the game")
+            for issue in response_dict['issues']:
+                print(f"[{issue['issue_id']}] {issue['title']} (round "
+                      f"{issue['round']}, {issue['vote_count']} votes)")
+            if response_dict['next_cursor'] is not None:
+                print(f"More issues: list_issues "
+                      f"{response_dict['next_cursor']}")
+        else:
+            self.print_error_response(response)
+
     def do_new_game(self, inp):
         """
         Start new game
@@ -284,6 +656,22 @@ class MyPrompt(Cmd):
             else:
                 self.print_error_response(response)
 
+    def do_remove_room(self, room_id):
+        """
+        Remove a room, and the game played in it, from the server
+        """
+        params_dict = {
+            'room_id': room_id
+        }
+        response = self.send_request(method='post',
+                                     route='/room/remove',
+                                     params=params_dict)
+        if response.status_code == status.HTTP_200_OK:
+            response_dict = json.loads(response.text)
+            print(f"{response_dict['result_message']}")
+        else:
+            self.print_error_response(response)
+
     def do_reset_votes(self, inp):
         """
         Reset votes on current issue
@@ -310,19 +698,16 @@ class MyPrompt(Cmd):
         """
         Show how many users are registered for the current game
         """
-        response = self.send_request(method='get',
-                                     route='/user/count')
-        if response.status_code == status.HTTP_200_OK:
-            response_dict = json.loads(response.text)
-            user_count = response_dict['result_message']['user_count']
-            if user_count == 1:
-                verb = 'is'
-            else:
-                verb = 'are'
-            print(f"Currently, there {verb} {user_count} registered "
-                  f"players")
+        crt_state = self.get_state()
+        if crt_state is None:
+            return
+        user_count = len(crt_state['current_users'])
+        if user_count == 1:
+            verb = 'is'
         else:
-            self.print_error_response(response)
+            verb = 'are'
+        print(f"Currently, there {verb} {user_count} registered "
+              f"players")
 
     def do_vote_issue(self, vote_value):
         """
@@ -345,13 +730,9 @@ class MyPrompt(Cmd):
         """
         Show voting system for the current game
         """
-        response = self.send_request(method='get',
-                                     route='/game/voting_system')
-        if response.status_code == status.HTTP_200_OK:
-            response_dict = json.loads(response.text)
-            print(f"{response_dict['result_message']}")
-        else:
-            self.print_error_response(response)
+        crt_state = self.get_state()
+        if crt_state is not None:
+            print(f"Voting system '{crt_state['voting_system']}' is selected")
 
     do_EOF = do_exit
 
@@ -364,6 +745,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str,
                         help="Configuration file name")
+    parser.add_argument("-f", "--file", type=str,
+                        help="Run the commands of this file, one per line, "
+                             "instead of prompting for them")
     args = parser.parse_args()
     if args.config:
         config_path = Path(args.config)
@@ -381,4 +765,8 @@ if __name__ == '__main__':
               f"the file exists. Will use default configuration parameters "
               f"this time.")
 
-    MyPrompt(**crt_config_params).cmdloop()
+    prompt = MyPrompt(**crt_config_params)
+    if args.file:
+        prompt.run_script(args.file)
+    else:
+        prompt.cmdloop()
@@ -0,0 +1,19 @@
+def create_session(request_retries: int, backoff_factor: float):
+    # requests is imported here, on the first command, and not when the
+    # CLI starts
+    import requests
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # only reads are retried: a write (e.g. PUT /issue/add_bulk) that the
+    # server applied before failing would be applied again
+    retry = Retry(total=request_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=[502, 503, 504],
+                  method_whitelist=frozenset({'GET', 'HEAD'}))
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
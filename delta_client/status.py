@@ -0,0 +1,6 @@
+HTTP_200_OK = 200
+HTTP_304_NOT_MODIFIED = 304
+HTTP_400_BAD_REQUEST = 400
+HTTP_404_NOT_FOUND = 404
+HTTP_412_PRECONDITION_FAILED = 412
+HTTP_422_UNPROCESSABLE_ENTITY = 422
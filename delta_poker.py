@@ -1,38 +1,570 @@
+import asyncio
+import contextlib
+import inspect
+import json
 import logging
+import time
 
+from analytics import ResultsAnalytics
+from events import CLOSED_EVENT
+from events import EVENTS_KEEPALIVE
+from events import LONG_POLL_MAX_WAIT
+from events import format_event
 from fastapi import Body
+from fastapi import Depends
 from fastapi import FastAPI
+from fastapi import Header
 from fastapi import HTTPException
 from fastapi import Query
+from fastapi import Request
+from fastapi import Response
 from fastapi import status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
+from game import ConsensusPolicy
 from game import User
 from game import UserVote
 from game import Game
+from game import NewIssue
+from game import Operation
 from game import VotingSystem
+from metrics import PROMETHEUS_CONTENT_TYPE
+from metrics import Metrics
+from metrics import MetricsMiddleware
+from persistence import SYNC_INTERVAL
+from persistence import create_state_store
+from profiling import ProfilingMiddleware
+from profiling import RequestProfiler
+from pydantic import BaseModel
+from pydantic import ValidationError
+from pydantic import conlist
+from pydantic import parse_obj_as
+from results_log import ResultsLog
+from results_writer import ResultsWriter
+from rooms import DEFAULT_ROOM_ID
+from rooms import Room
+from rooms import RoomRegistry
+from single_flight import SingleFlight
+from typing import Callable
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import get_type_hints
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 logger = logging.getLogger(__name__)
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+MAX_ISSUE_PAGE_SIZE = 500
+MAX_BATCH_SIZE = 500
+# seconds a client is asked to wait when the state store stays locked
+STORE_BUSY_RETRY_AFTER = 1
+# the game operations a batch may hold, those of the CLI's scripted mode
+BATCH_OPERATIONS = ('add_issues', 'add_user', 'goto_issue', 'new_game',
+                    'remove_player', 'reset_votes', 'set_next_issue',
+                    'set_previous_issue', 'vote_issue')
+
+# game events that change each cached read response; the responses that
+# carry the game version change on every event and list none
+DEALER_EVENTS = ('user_added', 'user_removed', 'new_game')
+CURRENT_ISSUE_EVENTS = ('issue_changed', 'vote', 'votes_reset', 'new_game')
+USERS_EVENTS = ('user_added', 'user_removed', 'new_game')
+VOTING_SYSTEM_EVENTS = ('voting_system_changed',)
+
 app = FastAPI()
-game = Game(VotingSystem['fibonacci'].value)
+registry = RoomRegistry()
+state_store = create_state_store(registry)
+results_log = ResultsLog()
+results_writer = ResultsWriter(results_log)
+results_analytics = ResultsAnalytics()
+single_flight = SingleFlight()
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+request_profiler = RequestProfiler()
+if request_profiler.enabled:
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+
+async def get_room_id(x_room_id: str = Header(DEFAULT_ROOM_ID)) -> str:
+    return x_room_id
+
+
+async def get_game(x_room_id: str = Header(DEFAULT_ROOM_ID)) -> Game:
+    await state_store.sync()
+    game = registry.get_room(x_room_id)
+    if game is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Couldn't find room '{x_room_id}'. Please add it first.")
+    return game
+
+
+@contextlib.asynccontextmanager
+async def store_transaction():
+    async with contextlib.AsyncExitStack() as stack:
+        # only a timeout taking the lock is a 503, not one of the body
+        try:
+            await stack.enter_async_context(state_store.transaction())
+        except TimeoutError as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"{e}. Please retry.",
+                headers={'Retry-After': str(STORE_BUSY_RETRY_AFTER)})
+        yield
+
+
+@contextlib.asynccontextmanager
+async def game_transaction(game: Game):
+    # the state store is locked first, so that readers of the room don't
+    # wait while another worker holds it
+    async with store_transaction():
+        async with game.lock:
+            # catching up with other workers may have replaced the room
+            if registry.get_room(game.room_id) is not game:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Room '{game.room_id}' was changed meanwhile. "
+                           f"Please retry.")
+            yield
+
+
+def get_etag(game: Game) -> str:
+    # room_uid changes when a room is recreated, so versions never clash
+    return f'"{game.room_uid}-{game.version}"'
+
+
+def not_modified(game: Game, response: Response,
+                 if_none_match: Optional[str]) -> Optional[Response]:
+    etag = get_etag(game)
+    if if_none_match is not None:
+        client_etags = {client_etag.strip()[2:]
+                        if client_etag.strip().startswith('W/')
+                        else client_etag.strip()
+                        for client_etag in if_none_match.split(',')}
+        if etag in client_etags or '*' in client_etags:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    return None
+
+
+def cached_response(game: Game, key: str, build: Callable[[], Dict],
+                    events: Optional[Tuple[str, ...]] = None) -> Response:
+    body = game.responses.get(key)
+    if body is None:
+        body = JSONResponse(jsonable_encoder(build())).body
+        game.responses.set(key, body, events)
+    return Response(body, media_type='application/json',
+                    headers={'ETag': get_etag(game)})
+
+
+def build_results(game: Game, left_to_vote: List) -> Dict:
+    if len(left_to_vote) == 0:
+        vote_distribution = game.count_votes()
+        return {"result_message": {
+                    "status": "done",
+                    "report": vote_distribution
+                    },
+                "version": game.version
+                }
+    else:
+        response = {"result_message": {
+                        "status": "pending",
+                        "report": f"Left to vote: {left_to_vote}"
+                        },
+                    "version": game.version
+                    }
+        advanced_from = game.get_advanced_from()
+        if advanced_from is not None:
+            response["result_message"]["previous_issue"] = {
+                "title": advanced_from['title'],
+                "report": advanced_from['report']}
+        return response
+
+
+def collect_per_room(count: Callable[[Game], int]) -> Callable[[], Dict]:
+    return lambda: {f'room="{room_id}"': count(game)
+                    for room_id, game in registry.rooms.items()}
+
+
+def current_issue_votes(game: Game) -> int:
+    try:
+        return game.get_number_of_votes()
+    except IndexError:
+        return 0
+
+
+metrics.add_gauge('delta_users', "Players in each room",
+                  collect_per_room(lambda game: len(game.users)))
+metrics.add_gauge('delta_issues', "Issues in each room",
+                  collect_per_room(lambda game: len(game.issues_list)))
+metrics.add_gauge('delta_current_issue_votes',
+                  "Votes on the current issue of each room",
+                  collect_per_room(current_issue_votes))
+metrics.add_gauge('delta_results_queue_depth',
+                  "Results waiting for the background writer",
+                  lambda: {'': results_writer.pending})
+metrics.add_gauge('delta_results_written_total',
+                  "Results appended to the results log",
+                  lambda: {'': results_writer.records_written},
+                  metric_type='counter')
+metrics.add_gauge('delta_response_cache_hits_total',
+                  "Read responses served from each room's cache",
+                  collect_per_room(lambda game: game.responses.hits),
+                  metric_type='counter')
+metrics.add_gauge('delta_response_cache_misses_total',
+                  "Read responses computed in each room",
+                  collect_per_room(lambda game: game.responses.misses),
+                  metric_type='counter')
+metrics.add_gauge('delta_single_flight_calls_total',
+                  "Calls of each coalesced computation",
+                  lambda: {f'name="{name}"': counts[0]
+                           for name, counts in single_flight.counts.items()},
+                  metric_type='counter')
+metrics.add_gauge('delta_single_flight_shared_total',
+                  "Calls that shared a computation already running",
+                  lambda: {f'name="{name}"': counts[1]
+                           for name, counts in single_flight.counts.items()},
+                  metric_type='counter')
+
+
+def submit_consensus(game: Game):
+    consensus = game.pop_consensus()
+    if consensus is not None:
+        results_writer.submit(*consensus)
+
+
+def submit_results(game: Game) -> Dict:
+    left_to_vote = game.left_to_vote()
+    if len(left_to_vote) == 0:
+        results_writer.submit(game.get_issue_results_key(),
+                              game.get_issue_results())
+    return build_results(game, left_to_vote)
+
+
+def normalize_args(op: str, args: Dict) -> Dict:
+    """
+    Validates the arguments of a game operation against its signature,
+    coercing them as the single-operation endpoints would, and returns
+    them encoded as the journal stores them (pydantic models as dicts).
+    """
+    method = getattr(Game, op)
+    inspect.signature(method).bind(None, **args)
+    hints = get_type_hints(method)
+    normalized = {}
+    for name, value in args.items():
+        if name == 'issues':
+            if not isinstance(value, list):
+                raise ValueError("Expected a list of issues")
+            value = [NewIssue(**issue).dict() for issue in value]
+        else:
+            value = parse_obj_as(hints[name], value)
+        normalized[name] = value.dict() if isinstance(value, BaseModel) \
+            else value
+    return normalized
+
+
+def check_batch(game: Game, operations: List[Operation]) -> List[Dict]:
+    """
+    Checks the operations in order against the only parts of the game
+    they depend on (players, dealer and issues), with the checks the
+    single-operation endpoints make, so that a batch with an operation
+    that would fail is rejected before any of them is applied. Nothing
+    is copied but the players.
+
+    Returns the arguments of every operation as validated, which are
+    the ones to apply.
+    """
+    users = set(game.users)
+    dealer = game.dealer
+    issues_count = len(game.issues_list)
+    # ids of the game's issues, unless a new game dropped them, and of
+    # the issues added by the batch
+    game_issues = True
+    first_added_id = next_issue_id = game.next_issue_id
+    checked_args = []
+    for index, operation in enumerate(operations):
+        op = operation.op
+        try:
+            if op not in BATCH_OPERATIONS:
+                raise ValueError("this operation can't run in a batch")
+            args = normalize_args(op, operation.args)
+            if op == 'add_user':
+                username = User(name=args['username']).name
+                users.add(username)
+                if dealer is None:
+                    dealer = username
+            elif op == 'add_issues':
+                issues_count += len(args['issues'])
+                next_issue_id += len(args['issues'])
+            elif op == 'vote_issue':
+                user_vote = UserVote(**args['user_vote'])
+                if user_vote.name not in users:
+                    raise ValueError(f"Please add the user "
+                                     f"'{user_vote.name}' to the game")
+                if user_vote.vote_value not in game.voting_system:
+                    raise ValueError(f"Please select a vote from the "
+                                     f"current voting system: "
+                                     f"{game.voting_system}")
+                if issues_count == 0:
+                    raise ValueError("Please add issues to the game")
+            else:
+                is_dealer = dealer is not None and \
+                    User(**args['user']).name == dealer
+                if op == 'goto_issue':
+                    issue_id = args['issue_id']
+                    if not (game_issues and issue_id in game.issue_positions
+                            or first_added_id <= issue_id < next_issue_id):
+                        raise ValueError(f"Couldn't find issue {issue_id}")
+                elif op == 'new_game' and is_dealer:
+                    users, dealer, issues_count = set(), None, 0
+                    game_issues = False
+                    first_added_id = next_issue_id
+                elif op == 'remove_player' and is_dealer and \
+                        args['username'] != dealer:
+                    users.discard(args['username'])
+                elif op == 'reset_votes' and is_dealer and issues_count == 0:
+                    raise ValueError("Please add issues to the game")
+        except Exception as e:
+            raise ValueError(f"Operation {index} ('{op}') failed: {e}")
+        checked_args.append(args)
+    return checked_args
+
+
+def build_vote_status(game: Game) -> Dict:
+    left_to_vote_count = game.left_to_vote()
+    crt_version = game.version
+    users_count = len(game.users)
+    if len(left_to_vote_count) == 0:
+        if users_count == 0:
+            return {"result_message": ("Players need to be registered in ",
+                                       "order to vote"),
+                    "version": crt_version}
+        return {"result_message": ("Every registered player has voted. ",
+                                   "You can type show_report to see votes"),
+                "version": crt_version}
+    if len(left_to_vote_count) > 1:
+        verb = "have"
+    elif len(left_to_vote_count) == 1:
+        verb = "has"
+    return {"result_message": f"{left_to_vote_count} still {verb} to vote",
+            "version": crt_version}
+
+
+def build_state(game: Game) -> Dict:
+    try:
+        crt_issue = game.get_current_issue.to_dict()
+        vote_status = build_vote_status(game)['result_message']
+    except IndexError:
+        crt_issue, vote_status = None, None
+    return {"result_message": {
+                "room_id": game.room_id,
+                "current_dealer": game.get_dealer,
+                "voting_system": game.voting_system,
+                "current_issue": crt_issue,
+                "current_users": list(game.users),
+                "vote_status": vote_status
+                },
+            "version": game.version
+            }
+
+
+async def iter_ndjson(request: Request):
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+async def wait_for_change(game: Game, wait: float,
+                          version: Optional[int]) -> Game:
+    if wait > 0 and version is not None:
+        await game.events.wait(lambda: game.version != version, wait)
+    # catching up with other workers may have replaced the room meanwhile
+    return await get_game(game.room_id)
+
+
+@app.on_event("startup")
+async def restore_state():
+    start_time = time.monotonic()
+    replayed = state_store.recover()
+    logger.info(f"Restored {len(registry.rooms)} room(s), replaying "
+                f"{replayed} operation(s), in "
+                f"{time.monotonic() - start_time:.3f}s")
+
+
+async def sync_state():
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        try:
+            await state_store.sync()
+        except Exception:
+            logger.exception("Couldn't catch up with the shared state")
+
+
+@app.on_event("startup")
+async def start_state_sync():
+    # wakes up long polls and event streams on changes made by other
+    # workers, which no request of this worker would sync
+    if state_store.shared:
+        app.state.sync_task = asyncio.create_task(sync_state())
+
+
+@app.on_event("startup")
+async def load_results_analytics():
+    start_time = time.monotonic()
+    await run_in_threadpool(results_log.subscribe,
+                            results_analytics.add_records)
+    logger.info(f"Loaded {results_analytics.result_rooms.size} result(s) "
+                f"for analytics in {time.monotonic() - start_time:.3f}s")
+
+
+@app.on_event("startup")
+async def start_results_writer():
+    results_writer.start()
+
+
+@app.on_event("shutdown")
+async def stop_results_writer():
+    await results_writer.stop()
+
+
+@app.on_event("shutdown")
+async def save_state():
+    sync_task = getattr(app.state, 'sync_task', None)
+    if sync_task is not None:
+        sync_task.cancel()
+    state_store.close()
 
 
 @app.get("/")
-def greet_users():
+async def greet_users():
     return "Welcome to a friendly game of Planning Poker"
 
 
+@app.get("/admin/profiles")
+async def show_profiles() -> Dict:
+    profiles = await run_in_threadpool(request_profiler.list_profiles)
+    return {"result_message": {"profiles": profiles}}
+
+
+@app.get("/admin/profiles/{name}", response_class=PlainTextResponse)
+async def show_profile(name: str,
+                       sort_by: str = Query('cumulative'),
+                       limit: int = Query(50, ge=1)):
+    try:
+        profile = await run_in_threadpool(request_profiler.read_profile,
+                                          name, sort_by, limit)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Couldn't sort the profile by '{sort_by}'")
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Couldn't find profile '{name}'")
+    return PlainTextResponse(profile)
+
+
+@app.post("/game/batch")
+async def run_batch(operations: conlist(Operation, min_items=1,
+                                        max_items=MAX_BATCH_SIZE) = Body(
+                        ..., embed=True),
+                    game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        try:
+            checked_args = check_batch(game, operations)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=[{"msg": f"{e}. No operations were applied"}])
+        results = []
+        for operation, args in zip(operations, checked_args):
+            results.append(game.apply(operation.op, args))
+            # each vote may reach consensus on its own issue
+            submit_consensus(game)
+    return {"result_message": {"results": results},
+            "version": game.version}
+
+
+@app.post("/game/consensus_policy")
+async def set_consensus_policy(user: User = Body(...),
+                               policy: ConsensusPolicy = Body(...),
+                               game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        policy_set = game.set_consensus_policy(user, policy)
+    if policy_set:
+        return {"result_message": {"consensus_policy": game.consensus_policy}}
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=("Only the dealer can change the consensus policy. ",
+                    "If there is no dealer, please add one."))
+
+
+@app.get("/game/events")
+async def stream_events(request: Request, wait: float = Query(0, ge=0),
+                        game: Game = Depends(get_game)):
+    # with wait > 0, the stream ends after that many seconds, since the
+    # keepalives would keep a client's read timeout from ever firing
+    deadline = time.monotonic() + wait if wait > 0 else None
+    queue = game.events.subscribe()
+
+    async def event_stream():
+        try:
+            yield ": subscribed\n\n"
+            while True:
+                timeout = EVENTS_KEEPALIVE
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        break
+                try:
+                    event = await asyncio.wait_for(queue.get(),
+                                                   timeout=timeout)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if event['event'] == CLOSED_EVENT:
+                    # the room was replaced: the client has to reconnect
+                    break
+                yield format_event(event)
+        finally:
+            game.events.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/game/get_dealer")
-def dealer_user() -> Dict:
-    return {"result_message": {"current_dealer": game.get_dealer}}
+async def dealer_user(response: Response,
+                      if_none_match: Optional[str] = Header(None),
+                      game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    return cached_response(
+        game, 'dealer',
+        lambda: {"result_message": {"current_dealer": game.get_dealer}},
+        DEALER_EVENTS)
 
 
 @app.post("/game/new")
-def start_new_game(user: User = Body(...)) -> Dict:
-    new_game_started = game.new_game(user)
+async def start_new_game(user: User = Body(...),
+                         game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        new_game_started = game.new_game(user)
     if new_game_started:
         return {"result_message": f"Started new game using voting system "
                                   f"'{game.voting_system}' is selected"}
@@ -43,24 +575,94 @@ def start_new_game(user: User = Body(...)) -> Dict:
                     "there is no dealer, please add one."))
 
 
+@app.get("/game/state")
+async def show_state(response: Response,
+                     if_none_match: Optional[str] = Header(None),
+                     game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    async with game.lock:
+        return cached_response(game, 'state', lambda: build_state(game))
+
+
 @app.get("/game/voting_system")
-def get_voting_system() -> Dict:
-    return {
-        "result_message": f"Voting system '{game.voting_system}' is selected"}
+async def get_voting_system(response: Response,
+                            if_none_match: Optional[str] = Header(None),
+                            game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    return cached_response(
+        game, 'voting_system',
+        lambda: {"result_message": f"Voting system '{game.voting_system}' "
+                                   f"is selected"},
+        VOTING_SYSTEM_EVENTS)
 
 
 @app.put("/issue/add")
-def add_issue(title: str = Body(...),
-              description: Optional[str] = Body(None)) -> Dict:
-    game.add_issue(title=title, description=description)
+async def add_issue(title: str = Body(...),
+                    description: Optional[str] = Body(None),
+                    game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        game.add_issue(title=title, description=description)
     return {"result_message": f"Issue '{title}' was added"}
 
 
+@app.put("/issue/add_bulk")
+async def add_issues(request: Request,
+                     game: Game = Depends(get_game)) -> Dict:
+    content_type = request.headers.get('content-type', '')
+    try:
+        if content_type.startswith(NDJSON_CONTENT_TYPE):
+            raw_issues = [raw_issue async for raw_issue in
+                          iter_ndjson(request)]
+        else:
+            raw_issues = json.loads(await request.body())
+            if not isinstance(raw_issues, list):
+                raise ValueError("Expected a JSON array of issues")
+        issues = [NewIssue(**raw_issue).dict() for raw_issue in raw_issues]
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=[{"msg": f"Couldn't add issues, none were added: {e}"}])
+    async with game_transaction(game):
+        game.add_issues(issues)
+    return {"result_message": f"{len(issues)} issue(s) were added"}
+
+
+@app.get("/issue/consensus")
+async def current_consensus(response: Response,
+                            if_none_match: Optional[str] = Header(None),
+                            game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    try:
+        return {"result_message": {
+                    "issue": game.get_current_issue.to_consensus(),
+                    "consensus_policy": game.consensus_policy
+                    }
+                }
+    except IndexError as e:
+        logger.error(f"Found {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Please add issues to the game")
+
+
 @app.get("/issue/current")
-def current_issue():
+async def current_issue(response: Response,
+                        if_none_match: Optional[str] = Header(None),
+                        game: Game = Depends(get_game)):
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
     try:
-        crt_issue = game.get_current_issue
-        return {"result_message": crt_issue}
+        return cached_response(
+            game, 'current_issue',
+            lambda: {"result_message": game.get_current_issue.to_dict()},
+            CURRENT_ISSUE_EVENTS)
     except IndexError as e:
         logger.error(f"Found {e}")
         raise HTTPException(
@@ -68,72 +670,109 @@ def current_issue():
             detail="Please add issues to the game")
 
 
+@app.post("/issue/goto")
+async def go_to_issue(user: User = Body(...), issue_id: int = Query(...),
+                      game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        if issue_id not in game.issue_positions:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Couldn't find issue {issue_id}")
+        if not game.goto_issue(user, issue_id):
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail=("Only the dealer can change the current issue. ",
+                        "If there is no dealer, please add one."))
+        return {"result_message": game.get_current_issue.to_dict()}
+
+
+@app.get("/issue/list")
+async def list_issues(response: Response,
+                      cursor: Optional[int] = Query(None),
+                      limit: int = Query(50, ge=1, le=MAX_ISSUE_PAGE_SIZE),
+                      title: Optional[str] = Query(None),
+                      if_none_match: Optional[str] = Header(None),
+                      game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    try:
+        page, next_cursor = game.get_issue_page(cursor, limit, title)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{e}. Please list the issues again from the start")
+    return {"result_message": {
+                "issues": [issue.to_summary() for issue in page],
+                "next_cursor": next_cursor
+                },
+            "version": game.version
+            }
+
+
 @app.post("/issue/next")
-def go_to_next_issue(user: User = Body(...)) -> Dict:
-    _ = game.set_next_issue(user)
-    return {"result_message": game.get_current_issue}
+async def go_to_next_issue(user: User = Body(...),
+                           game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        _ = game.set_next_issue(user)
+        return {"result_message": game.get_current_issue.to_dict()}
 
 
 @app.post("/issue/previous")
-def go_to_previous_issue(user: User = Body(...)) -> Dict:
-    _ = game.set_previous_issue(user)
-    return {"result_message": game.get_current_issue}
+async def go_to_previous_issue(user: User = Body(...),
+                               game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        _ = game.set_previous_issue(user)
+        return {"result_message": game.get_current_issue.to_dict()}
 
 
 @app.get("/issue/show_results")
-def show_results() -> Dict:
-    if len(game.left_to_vote()) == 0:
-        if game.report_queue.qsize() == 0:
-            game.report_queue.put("dump_request")
-            game.dump_issue_results()
-        try:
-            vote_distribution = game.count_votes()
-            return {"result_message": {
-                        "status": "done",
-                        "report": vote_distribution
-                        }
-                    }
-        except IndexError as e:
-            logger.error(f"Found {e}")
-            raise HTTPException(
-                status_code=status.HTTP_412_PRECONDITION_FAILED,
-                detail="Please add issues to the game"
-            )
-    else:
-        return {"result_message": {
-                    "status": "pending",
-                    "report": f"Left to vote: {game.left_to_vote()}"
-                    }
-                }
+async def show_results(response: Response,
+                       wait: float = Query(0, ge=0, le=LONG_POLL_MAX_WAIT),
+                       version: Optional[int] = Query(None),
+                       if_none_match: Optional[str] = Header(None),
+                       game: Game = Depends(get_game)) -> Dict:
+    game = await wait_for_change(game, wait, version)
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    try:
+        async with game.lock:
+            return cached_response(game, 'results',
+                                   lambda: submit_results(game))
+    except IndexError as e:
+        logger.error(f"Found {e}")
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Please add issues to the game"
+        )
 
 
 @app.get("/issue/vote_status")
-def get_issue_votes():
+async def get_issue_votes(response: Response,
+                          wait: float = Query(0, ge=0, le=LONG_POLL_MAX_WAIT),
+                          version: Optional[int] = Query(None),
+                          if_none_match: Optional[str] = Header(None),
+                          game: Game = Depends(get_game)):
+    game = await wait_for_change(game, wait, version)
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
     try:
-        left_to_vote_count = game.left_to_vote()
+        return cached_response(game, 'vote_status',
+                               lambda: build_vote_status(game))
     except IndexError as e:
         logger.error(f"Found {e}")
         raise HTTPException(
             status_code=status.HTTP_412_PRECONDITION_FAILED,
             detail="Please add issues to the game"
         )
-    if len(left_to_vote_count) == 0:
-        if len(game.users) == 0:
-            return {"result_message": ("Players need to be registered in ",
-                                       "order to vote")}
-        return {"result_message": ("Every registered player has voted. ",
-                                   "You can type show_report to see votes")}
-    if len(left_to_vote_count) > 1:
-        verb = "have"
-    elif len(left_to_vote_count) == 1:
-        verb = "has"
-    return {"result_message": f"{left_to_vote_count} still {verb} to vote"}
 
 
 @app.put("/issue/vote")
-def add_user_vote(user_vote: UserVote = Body(...)):
-    crt_users = [user.name for user in game.users.values()]
-    if user_vote.name not in crt_users:
+async def add_user_vote(user_vote: UserVote = Body(...),
+                        game: Game = Depends(get_game)):
+    if user_vote.name not in game.users:
         raise HTTPException(
             status_code=status.HTTP_412_PRECONDITION_FAILED,
             detail=f"Please add the user '{user_vote.name}' to the game")
@@ -144,24 +783,28 @@ def add_user_vote(user_vote: UserVote = Body(...)):
             detail=f"Please select a vote from the current voting system: "
                    f"{game.voting_system}")
 
-    vote_status = game.vote_issue(user_vote=user_vote)
-    crt_issue = game.get_current_issue
+    async with game_transaction(game):
+        # the vote may reach consensus and move the game to the next issue
+        crt_issue = game.get_current_issue
+        vote_status = game.vote_issue(user_vote=user_vote)
+        submit_consensus(game)
     if vote_status:
         return {"result_message": f"{user_vote.name}'s "
                                   f"'{user_vote.vote_value}' "
                                   f"was registered on "
-                                  f"{crt_issue.dict()['title']}"}
+                                  f"{crt_issue.title}"}
     else:
         return {"result_message": f"{user_vote.name} already voted on "
-                                  f"{crt_issue.dict()['title']}"}
+                                  f"{crt_issue.title}"}
 
 
 @app.post("/issue/votes_reset")
-def reset_votes(user: User = Body(...)):
-    votes_reset = game.reset_votes(user)
+async def reset_votes(user: User = Body(...), game: Game = Depends(get_game)):
+    async with game_transaction(game):
+        votes_reset = game.reset_votes(user)
     if votes_reset:
         return {"result_message": f"Reset votes on issue "
-                                  f"{game.get_current_issue}"}
+                                  f"'{game.get_current_issue.title}'"}
     else:
         raise HTTPException(
             status_code=status.HTTP_412_PRECONDITION_FAILED,
@@ -169,31 +812,123 @@ def reset_votes(user: User = Body(...)):
                     "If there is no dealer, please add one."))
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def show_metrics():
+    return PlainTextResponse(metrics.render(),
+                             media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/results/analytics")
+async def show_results_analytics(all_rooms: bool = Query(False),
+                                 since: Optional[float] = Query(None),
+                                 room_id: str = Depends(get_room_id)) -> Dict:
+    # picks up the results appended by other workers
+    await single_flight.run('results_refresh', None, results_log.refresh)
+    room_id = None if all_rooms else room_id
+    summary = await single_flight.run(
+        'results_analytics',
+        (room_id, since, results_analytics.result_rooms.size),
+        results_analytics.summary, room_id, since)
+    return {"result_message": summary}
+
+
+@app.get("/results/history")
+async def show_issue_history(title: str = Query(...),
+                             issue_round: Optional[int] = Query(
+                                 None, alias="round"),
+                             issue_id: Optional[int] = Query(None),
+                             room_id: str = Depends(get_room_id)) -> Dict:
+    history = await single_flight.run(
+        'results_history',
+        (room_id, title, issue_round, issue_id,
+         len(results_log.record_keys)),
+        results_log.history, room_id, title, issue_round, issue_id)
+    return {"result_message": {"history": history}}
+
+
+@app.post("/room/add")
+async def add_room(room: Room = Body(...)) -> Dict:
+    if room.voting_system not in VotingSystem.__members__:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please select a voting system from "
+                   f"{list(VotingSystem.__members__)}")
+    async with store_transaction():
+        room_added = registry.add_room(room.room_id, room.voting_system)
+    if not room_added:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Room '{room.room_id}' already exists")
+    return {"result_message": f"Room '{room.room_id}' was added"}
+
+
+@app.post("/room/remove")
+async def remove_room(room_id: str = Query(...)) -> Dict:
+    async with store_transaction():
+        room_removed = registry.remove_room(room_id)
+    if not room_removed:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Couldn't remove room '{room_id}'. The default room "
+                   f"can't be removed.")
+    return {"result_message": f"Room '{room_id}' was removed"}
+
+
+@app.get("/room/show_all")
+async def show_all_rooms() -> Dict:
+    await state_store.sync()
+    return {"result_message": {"rooms": registry.show_rooms()}}
+
+
 @app.post("/user/add")
-def add_user(user: User = Body(...)) -> Dict:
-    game.add_user(user.name)
+async def add_user(user: User = Body(...),
+                   game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        game.add_user(user.name)
     return {"result_message": f"User '{user.name}' was added"}
 
 
 @app.get("/user/count")
-def count_users() -> Dict:
-    return {"result_message": {"user_count": len(game.users)}}
+async def count_users(response: Response,
+                      if_none_match: Optional[str] = Header(None),
+                      game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    return cached_response(
+        game, 'user_count',
+        lambda: {"result_message": {"user_count": len(game.users)}},
+        USERS_EVENTS)
 
 
 @app.post("/user/exit")
-def user_exit(user: User = Body(...)) -> Dict:
-    user_exit_status = game.exit_game(user)
+async def user_exit(user: User = Body(...),
+                    game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        user_exit_status = game.exit_game(user)
+        submit_consensus(game)
     return {"result_message": {"user_exit_status": user_exit_status}}
 
 
 @app.post("/user/remove")
-def remove_user(user: User = Body(...), username: str = Query(...)) -> Dict:
-    result_dict = game.remove_player(user, username)
+async def remove_user(user: User = Body(...), username: str = Query(...),
+                      game: Game = Depends(get_game)) -> Dict:
+    async with game_transaction(game):
+        result_dict = game.remove_player(user, username)
+        submit_consensus(game)
     return result_dict
 
 
 @app.get("/user/show_all")
-def show_all_users() -> Dict:
-    return {"result_message": {
-        "current_users": [x.name for x in game.show_users().values()]
-    }}
+async def show_all_users(response: Response,
+                         if_none_match: Optional[str] = Header(None),
+                         game: Game = Depends(get_game)) -> Dict:
+    cached = not_modified(game, response, if_none_match)
+    if cached is not None:
+        return cached
+    async with game.lock:
+        return cached_response(
+            game, 'current_users',
+            lambda: {"result_message": {"current_users": [
+                x.name for x in game.show_users().values()]}},
+            USERS_EVENTS)
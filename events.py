@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import json
+import logging
+import threading
+
+from typing import Callable
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+EVENTS_KEEPALIVE = 15
+LONG_POLL_MAX_WAIT = 60
+# the last event of a broadcaster, after which its streams end
+CLOSED_EVENT = 'closed'
+
+
+class EventBroadcaster:
+    """
+    Fans game events out to every subscribed stream and long-poll
+    waiter. Each subscriber is bound to the event loop it subscribed
+    from, so publishing works both from async endpoints and from the
+    threadpool.
+    """
+
+    def __init__(self, max_queue_size: int = 100):
+        self.max_queue_size = max_queue_size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        """
+        Ends every stream and wakes every waiter, e.g. when the game
+        they follow is replaced, so that clients come back to the new
+        one.
+        """
+        self.publish({'event': CLOSED_EVENT, 'version': None, 'data': {}})
+
+    def publish(self, event: Dict):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for subscriber, (loop, callback) in subscribers:
+            try:
+                loop.call_soon_threadsafe(callback, event)
+            except RuntimeError:
+                self.unsubscribe(subscriber)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._register(queue, functools.partial(self._put, queue))
+        return queue
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+
+    async def wait(self, changed: Callable[[], bool], timeout: float) -> bool:
+        state_changed = asyncio.Event()
+        self._register(state_changed, lambda event: state_changed.set())
+        try:
+            if changed():
+                return True
+            await asyncio.wait_for(state_changed.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.unsubscribe(state_changed)
+
+    def _register(self, subscriber, callback: Callable[[Dict], None]):
+        with self.lock:
+            self.subscribers[subscriber] = (asyncio.get_event_loop(),
+                                            callback)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, event: Dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning(f"Dropped '{event['event']}' event for a slow "
+                           f"subscriber")
+
+
+def format_event(event: Dict) -> str:
+    return (f"id: {event['version']}\n"
+            f"event: {event['event']}\n"
+            f"data: {json.dumps(event['data'])}\n\n")
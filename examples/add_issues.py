@@ -3,12 +3,23 @@ import json
 import requests
 import sys
 
-from fastapi import status
+
+def iter_ndjson(issues):
+    for issue in issues:
+        yield (json.dumps(issue) + '\n').encode()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--chunk-size", type=int, default=500,
+                        help="Set how many issues are sent per request")
     parser.add_argument("-f", "--filename", type=str,
                         help="Set filename from which to add_issues")
+    parser.add_argument("-n", "--ndjson", action='store_true',
+                        help="Stream every chunk as NDJSON instead of "
+                             "sending it as a JSON array")
+    parser.add_argument("-r", "--room", type=str, default="default",
+                        help="Set room to which the issues are added")
     parser.add_argument("-u", "--url", type=str,
                         help="Set poker server url")
     parser.add_argument("-v", "--verbose", action='store_true',
@@ -29,18 +40,31 @@ if __name__ == '__main__':
     with open(issues_filename) as f:
         issues_list = json.load(fp=f)
 
-    # add issue(s)
-    for crt_issue in issues_list:
-        try:
-            response = requests.put('/'.join([url, 'issue/add']),
-                                    json=crt_issue)
-        except requests.exceptions.ConnectionError as ce:
-            print(f"Server might not be running, or is not accesible from "
-                  f"this network: {ce}")
-            sys.exit(0)
-        if response.status_code == status.HTTP_200_OK:
-            if args.verbose:
-                response_dict = json.loads(response.text)
-                print(f"{json.dumps(json.loads(response.text), indent=4)}")
-        else:
-            print(f"Received {response.status_code} from server")
+    # add issue(s), one chunk per request, over a single connection
+    added_count = 0
+    with requests.Session() as session:
+        session.headers.update({'X-Room-Id': args.room})
+        for chunk_start in range(0, len(issues_list), args.chunk_size):
+            chunk = issues_list[chunk_start:chunk_start + args.chunk_size]
+            try:
+                if args.ndjson:
+                    response = session.put(
+                        '/'.join([url, 'issue/add_bulk']),
+                        data=iter_ndjson(chunk),
+                        headers={'Content-Type': 'application/x-ndjson'})
+                else:
+                    response = session.put('/'.join([url, 'issue/add_bulk']),
+                                           json=chunk)
+            except requests.exceptions.ConnectionError as ce:
+                print(f"Server might not be running, or is not accesible "
+                      f"from this network: {ce}")
+                sys.exit(0)
+            if response.status_code == requests.codes.ok:
+                added_count += len(chunk)
+                print(f"Added {added_count}/{len(issues_list)} issues")
+                if args.verbose:
+                    print(f"{json.dumps(json.loads(response.text), indent=4)}")
+            else:
+                print(f"Received {response.status_code} from server: "
+                      f"{response.text}")
+                sys.exit(1)
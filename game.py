@@ -1,18 +1,27 @@
-import json
-import os
+import asyncio
+import bisect
+import functools
+import inspect
 import re
 import time
+import uuid
 
-from queue import Queue
 from enum import Enum
+from events import EventBroadcaster
 from pydantic import BaseModel
+from pydantic import confloat
+from pydantic import conint
 from pydantic import constr
+from response_cache import ResponseCache
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Union
-
-RESULTS_PATH = './results'
+from typing import get_type_hints
 
 
 class User(BaseModel):
@@ -20,18 +29,167 @@ class User(BaseModel):
     old_name: Optional[Union[str, None]]
 
 
-class UserAuth(User):
-    is_dealer: bool
-
-
 class UserVote(User):
     vote_value: str
 
 
-class Issue(BaseModel):
+class NewIssue(BaseModel):
     title: str
     description: Optional[str] = None
-    votes: Optional[List[Dict]] = []
+
+
+class ConsensusPolicy(BaseModel):
+    enabled: bool = True
+    # share of the votes that must go to the most voted card
+    min_agreement: confloat(ge=0, le=1) = 1.0
+    # most card positions allowed between the lowest and highest vote
+    max_spread: Optional[conint(ge=0)] = None
+    auto_advance: bool = False
+
+
+class Operation(BaseModel):
+    # a journaled Game method and its arguments, as in the state log
+    op: str
+    args: Dict[str, Any] = {}
+
+
+# The pydantic models above validate requests at the API boundary. The
+# game itself keeps plain records with __slots__, which are cheaper to
+# create and to hold, and are turned into dicts only for responses.
+
+class Player:
+    __slots__ = ('name', 'is_dealer')
+
+    def __init__(self, name: str, is_dealer: bool):
+        self.name = name
+        self.is_dealer = is_dealer
+
+
+class Vote:
+    __slots__ = ('name', 'vote_value')
+
+    def __init__(self, name: str, vote_value: str):
+        self.name = name
+        self.vote_value = vote_value
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'old_name': None,
+                'vote_value': self.vote_value}
+
+
+class Issue:
+    __slots__ = ('issue_id', 'title', 'description', 'votes', 'round',
+                 'tally', 'card_min', 'card_max', 'mode', 'mode_count',
+                 'mode_tied', 'consensus', '_voters')
+
+    def __init__(self, issue_id: int, title: str,
+                 description: Optional[str] = None, issue_round: int = 1):
+        self.issue_id = issue_id
+        self.title = title
+        self.description = description
+        self.votes: List[Vote] = []
+        self.round = issue_round
+        self.tally: Dict = {}
+        # running spread statistics, kept as the votes arrive
+        self.card_min: Optional[int] = None
+        self.card_max: Optional[int] = None
+        self.mode: Optional[Union[int, str]] = None
+        self.mode_count = 0
+        # another card has as many votes as the mode
+        self.mode_tied = False
+        self.consensus: Optional[Union[int, str]] = None
+        self._voters: Set[str] = set()
+
+    @property
+    def agreement(self) -> Optional[float]:
+        return self.mode_count / len(self.votes) if self.votes else None
+
+    @property
+    def spread(self) -> Optional[int]:
+        if self.card_min is None:
+            return None
+        return self.card_max - self.card_min
+
+    def add_vote(self, vote: Vote, vote_key: Union[int, str],
+                 card_index: Optional[int] = None):
+        self.votes.append(vote)
+        self._voters.add(vote.name)
+        if vote_key in self.tally:
+            self.tally[vote_key]['vote_count'] += 1
+            self.tally[vote_key]['voters'].append(vote.name)
+        else:
+            self.tally[vote_key] = {
+                'vote_count': 1,
+                'voters': [vote.name]
+            }
+        vote_count = self.tally[vote_key]['vote_count']
+        if vote_count > self.mode_count:
+            self.mode = vote_key
+            self.mode_count = vote_count
+            self.mode_tied = False
+        elif vote_count == self.mode_count:
+            self.mode_tied = True
+        if card_index is not None:
+            if self.card_min is None or card_index < self.card_min:
+                self.card_min = card_index
+            if self.card_max is None or card_index > self.card_max:
+                self.card_max = card_index
+
+    def has_voted(self, username: str) -> bool:
+        return username in self._voters
+
+    def next_round(self) -> 'Issue':
+        return Issue(self.issue_id, self.title, self.description,
+                     self.round + 1)
+
+    def to_dict(self) -> Dict:
+        return {'issue_id': self.issue_id, 'title': self.title,
+                'description': self.description,
+                'votes': [vote.to_dict() for vote in self.votes]}
+
+    def to_consensus(self) -> Dict:
+        return {'issue_id': self.issue_id, 'title': self.title,
+                'round': self.round, 'card_min': self.card_min,
+                'card_max': self.card_max, 'spread': self.spread,
+                'mode': self.mode, 'mode_tied': self.mode_tied,
+                'agreement': self.agreement,
+                'consensus': self.consensus}
+
+    def to_summary(self) -> Dict:
+        return {'issue_id': self.issue_id, 'title': self.title,
+                'description': self.description, 'round': self.round,
+                'vote_count': len(self.votes)}
+
+
+def journaled(method: Callable) -> Callable:
+    """
+    Marks a Game method as a mutation: after it succeeds, the call is
+    handed to the game's journal, with pydantic arguments as dicts, so
+    that Game.apply can replay it later. Every change notifies, which
+    bumps the version, so a call that left the version alone (e.g. one
+    refused to a player who isn't the dealer) isn't journaled.
+    """
+    signature = inspect.signature(method)
+    model_params = {name: hint for name, hint in get_type_hints(
+        method).items() if inspect.isclass(hint) and
+        issubclass(hint, BaseModel)}
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        version = self.version
+        result = method(self, *args, **kwargs)
+        if self.journal is not None and self.version != version:
+            bound_args = signature.bind(self, *args, **kwargs)
+            encoded_args = {name: value.dict()
+                            if isinstance(value, BaseModel) else value
+                            for name, value in bound_args.arguments.items()
+                            if name != 'self'}
+            self.journal(self.room_id, method.__name__, encoded_args)
+        return result
+
+    wrapper.model_params = model_params
+    wrapper.is_journaled = True
+    return wrapper
 
 
 class VotingSystem(Enum):
@@ -45,16 +203,37 @@ class Game:
 
     VALID_CHARS_PATTERN = re.compile(r"[^a-zA-Z0-9-\[\]]")
 
-    def __init__(self, voting_system: List):
+    def __init__(self, voting_system: List, room_id: str = 'default',
+                 room_uid: Optional[str] = None):
+        self.room_id = room_id
+        self.room_uid = room_uid or uuid.uuid4().hex
+        self.games_started = 1
+        self.game_id = f"{self.room_uid}-{self.games_started}"
+        self.journal: Optional[Callable[[str, str, Dict], None]] = None
         self.voting_system = voting_system
         self.issues_list = []
+        # issue ids are never reused, so that a listing cursor stays valid
+        self.next_issue_id = 1
+        self.issue_positions: Dict[int, int] = {}
+        self.issue_ids_by_title: Dict[str, List[int]] = {}
         self.users = {}
         self.dealer = None
         self.current_issue_index = 0
         self.non_sortable = ["?", "coffee"]
-        self.report_queue = Queue()
-        if not os.path.exists(RESULTS_PATH):
-            os.mkdir(path=RESULTS_PATH)
+        self.card_indexes = self.get_card_indexes()
+        self.consensus_policy = ConsensusPolicy(enabled=False).dict()
+        self.last_consensus: Optional[Tuple[Tuple, Dict]] = None
+        # results of the last issue that auto_advance moved on from
+        self.advanced_from: Optional[Dict] = None
+        # how many of the current players voted on _voted_issue, kept up to
+        # date by every vote and player change, and recounted when the
+        # current issue changes, so that a vote doesn't rescan the voters
+        self._voted_issue: Optional[Issue] = None
+        self._voted_count = 0
+        self._lock = None
+        self.events = EventBroadcaster()
+        self.responses = ResponseCache()
+        self.version = 0
 
     @property
     def get_dealer(self):
@@ -64,54 +243,99 @@ class Game:
     def get_current_issue(self):
         return self.issues_list[self.current_issue_index]
 
+    @property
+    def lock(self) -> asyncio.Lock:
+        # created on first use, so that it binds to the server's loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @journaled
     def add_issue(self, title: str, description: Optional[str] = None):
-        self.issues_list.append(Issue(title=title, description=description))
+        self._append_issue(Issue(self.next_issue_id, title, description))
+        self._notify('issue_added', title=title)
+
+    @journaled
+    def add_issues(self, issues: List[Dict]):
+        for issue in issues:
+            self._append_issue(Issue(self.next_issue_id, issue['title'],
+                                     issue.get('description')))
+        self._notify('issues_added', count=len(issues))
 
+    @journaled
     def add_user(self, username: str):
-        self.report_queue = Queue()
-        user = UserAuth(name=username, is_dealer=self.get_dealer is None)
-        self.users[username] = user
+        if username not in self.users:
+            self._track_voter(username, 1)
+        self.users[username] = Player(username, self.get_dealer is None)
         if self.get_dealer is None:
             self.dealer = username
+        self._notify('user_added', name=username)
 
     def aggregate_votes(self) -> Dict:
-        results_dict = {}
-        crt_issue_votes = self.get_current_issue.votes
-        for vote in crt_issue_votes:
-            if self.voting_system != VotingSystem.t_shirt_sizes and \
-                    vote.vote_value not in self.non_sortable:
-                key = int(vote.vote_value)
-            else:
-                key = vote.value
-            if key in results_dict:
-                results_dict[key]['vote_count'] += 1
-                results_dict[key]['voters'].append(vote.name)
-            else:
-                results_dict[key] = {
-                    'vote_count': 1,
-                    'voters': [vote.name]
-                }
-        return results_dict
+        return dict(self.get_current_issue.tally)
+
+    def _append_issue(self, issue: Issue):
+        self.issue_positions[issue.issue_id] = len(self.issues_list)
+        self.issue_ids_by_title.setdefault(issue.title, []).append(
+            issue.issue_id)
+        self.issues_list.append(issue)
+        self.next_issue_id = max(self.next_issue_id, issue.issue_id + 1)
+
+    def apply(self, op: str, args: Dict):
+        method = getattr(self, op, None)
+        if not getattr(method, 'is_journaled', False):
+            raise ValueError(f"'{op}' is not a journaled Game operation")
+        decoded_args = {name: method.model_params[name](**value)
+                        if name in method.model_params else value
+                        for name, value in args.items()}
+        return method(**decoded_args)
+
+    def _check_consensus(self):
+        crt_issue = self.get_current_issue
+        policy = self.consensus_policy
+        if not policy['enabled'] or crt_issue.consensus is not None or \
+                crt_issue.mode is None or crt_issue.mode_tied or \
+                crt_issue.mode in self.non_sortable:
+            return
+        if crt_issue.agreement < policy['min_agreement']:
+            return
+        if policy['max_spread'] is not None and \
+                (crt_issue.spread is None or
+                 crt_issue.spread > policy['max_spread']):
+            return
+        crt_issue.consensus = crt_issue.mode
+        issue_results = self.get_issue_results()
+        self.last_consensus = (self.get_issue_results_key(), issue_results)
+        # the report goes with the event, since auto_advance may move
+        # the game on before a client fetches it
+        self._notify('consensus', title=crt_issue.title,
+                     estimate=crt_issue.consensus,
+                     agreement=crt_issue.agreement,
+                     report=issue_results['report'])
+        if policy['auto_advance'] and \
+                self.current_issue_index < len(self.issues_list) - 1:
+            self.advanced_from = issue_results
+            self.current_issue_index += 1
+            self._notify('issue_changed',
+                         title=self.get_current_issue.title)
 
     def count_votes(self, vote_value_sort=True) -> Dict:
         vote_results = self.aggregate_votes()
         if vote_value_sort:
-            return {k: v for k, v in sorted(vote_results.items(),
-                                            key=lambda x: x[0])}
+            return {k: v for k, v in sorted(
+                vote_results.items(),
+                key=lambda x: self.voting_system.index(str(x[0])))}
         else:
             return {k: v for k, v in sorted(vote_results.items(),
                                             key=lambda x: x[1]['vote_count'])}
 
-    def dump_issue_results(self):
-        crt_issue_title = self.validate_filename(self.get_current_issue.title)
-        filename = '_'.join([crt_issue_title, str(time.time())])
-        filepath = os.path.join(RESULTS_PATH, filename)
-        with open(filepath, 'w') as f:
-            json.dump(self.count_votes(), f)
-
+    @journaled
     def exit_game(self, user: User) -> str:
         if user.name in self.users:
             del self.users[user.name]
+            self._track_voter(user.name, -1)
+            self._notify('user_removed', name=user.name)
+            self._notify_if_report_ready()
         else:
             return f"Couldn't find user {user.name}"
         if self.dealer and self.get_dealer == user.name:
@@ -119,30 +343,175 @@ class Game:
             return f"Deleted dealer {user.name}"
         return f"Deleted user {user.name}"
 
-    def get_current_initial_issue(self) -> Issue:
-        crt_issue = self.get_current_issue.dict(exclude_unset=True)
-        return crt_issue
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict) -> 'Game':
+        game = cls(snapshot['voting_system'], room_id=snapshot['room_id'],
+                   room_uid=snapshot['room_uid'])
+        game.games_started = snapshot['games_started']
+        game.game_id = snapshot['game_id']
+        game.next_issue_id = snapshot.get('next_issue_id', 1)
+        for issue_snapshot in snapshot['issues']:
+            # snapshots taken before issue ids existed are numbered again
+            issue = Issue(issue_snapshot.get('issue_id', game.next_issue_id),
+                          issue_snapshot['title'],
+                          issue_snapshot['description'],
+                          issue_snapshot['round'])
+            for name, vote_value in issue_snapshot['votes']:
+                issue.add_vote(Vote(name, vote_value),
+                               game.get_vote_key(vote_value),
+                               game.card_indexes.get(vote_value))
+            issue.consensus = issue_snapshot.get('consensus')
+            game._append_issue(issue)
+        game.users = {name: Player(name, is_dealer)
+                      for name, is_dealer in snapshot['users']}
+        game.dealer = snapshot['dealer']
+        game.current_issue_index = snapshot['current_issue_index']
+        game.version = snapshot['version']
+        game.consensus_policy = snapshot.get('consensus_policy',
+                                             game.consensus_policy)
+        return game
+
+    def get_advanced_from(self) -> Optional[Dict]:
+        """
+        Returns the results of the issue that auto_advance just moved on
+        from, until somebody votes on the next issue or the game moves.
+        """
+        if self.advanced_from is None or \
+                self.get_number_of_votes() > 0 or \
+                self.issue_positions.get(self.advanced_from['issue_id']) != \
+                self.current_issue_index - 1:
+            return None
+        return self.advanced_from
+
+    def get_card_indexes(self) -> Dict[str, int]:
+        return {card: index for index, card in enumerate(self.voting_system)
+                if card not in self.non_sortable}
+
+    def get_current_initial_issue(self) -> Dict:
+        crt_issue = self.get_current_issue
+        return {'title': crt_issue.title,
+                'description': crt_issue.description}
+
+    def get_issue_page(self, cursor: Optional[int] = None,
+                       limit: int = 50, title: Optional[str] = None
+                       ) -> Tuple[List[Issue], Optional[int]]:
+        """
+        Returns up to `limit` issues after the issue with id `cursor`
+        (from the start without it), in backlog order and optionally
+        only those with the given title, and the cursor of the next
+        page, which is None on the last one.
+        """
+        if cursor is not None and cursor not in self.issue_positions:
+            raise ValueError(f"Couldn't find issue {cursor}")
+        if title is not None:
+            # ids grow with the position, so they are sorted too
+            issue_ids = self.issue_ids_by_title.get(title, [])
+            start = 0 if cursor is None else \
+                bisect.bisect_right(issue_ids, cursor)
+            page = [self.issues_list[self.issue_positions[issue_id]]
+                    for issue_id in issue_ids[start:start + limit]]
+            has_more = start + limit < len(issue_ids)
+        else:
+            start = 0 if cursor is None else self.issue_positions[cursor] + 1
+            page = self.issues_list[start:start + limit]
+            has_more = start + limit < len(self.issues_list)
+        next_cursor = page[-1].issue_id if has_more and page else None
+        return page, next_cursor
+
+    def get_issue_results(self) -> Dict:
+        crt_issue = self.get_current_issue
+        report = {k: {'vote_count': v['vote_count'],
+                      'voters': list(v['voters'])}
+                  for k, v in self.count_votes().items()}
+        return {
+            'room_id': self.room_id,
+            'game_id': self.game_id,
+            'issue_id': crt_issue.issue_id,
+            'title': crt_issue.title,
+            'round': crt_issue.round,
+            'timestamp': time.time(),
+            'report': report
+        }
+
+    def get_issue_results_key(self) -> Tuple:
+        return (self.game_id, self.current_issue_index,
+                self.get_current_issue.round, self.get_number_of_votes())
 
     def get_number_of_votes(self) -> int:
         return len(self.issues_list[self.current_issue_index].votes)
 
+    def get_vote_key(self, vote_value: str) -> Union[int, str]:
+        if self.voting_system != VotingSystem.t_shirt_sizes.value and \
+                vote_value not in self.non_sortable:
+            return int(vote_value)
+        return vote_value
+
+    @journaled
+    def goto_issue(self, user: User, issue_id: int) -> bool:
+        if self.dealer and user.name == self.dealer and \
+                issue_id in self.issue_positions:
+            self.current_issue_index = self.issue_positions[issue_id]
+            self._notify('issue_changed',
+                         title=self.get_current_issue.title)
+            return True
+        return False
+
+    def is_report_ready(self) -> bool:
+        return len(self.users) > 0 and \
+            self.count_players_voted() == len(self.users)
+
+    def count_players_voted(self) -> int:
+        crt_issue = self.get_current_issue
+        if self._voted_issue is not crt_issue:
+            self._voted_issue = crt_issue
+            self._voted_count = sum(1 for username in self.users
+                                    if crt_issue.has_voted(username))
+        return self._voted_count
+
     def left_to_vote(self) -> List:
         crt_issue = self.issues_list[self.current_issue_index]
-        crt_votes = [x.name for x in crt_issue.votes]
-        return [user.name for user in self.users.values()
-                if user.name not in crt_votes]
+        return [username for username in self.users
+                if not crt_issue.has_voted(username)]
 
+    @journaled
     def new_game(self, user: User) -> bool:
         if self.dealer and user.name == self.dealer:
+            self.games_started += 1
+            self.game_id = f"{self.room_uid}-{self.games_started}"
             self.current_issue_index = 0
             self.dealer = None
-            self.report_queue = Queue()
             self.issues_list = []
+            self.issue_positions = {}
+            self.issue_ids_by_title = {}
             self.users = {}
+            self.advanced_from = None
+            self._voted_issue = None
+            self._notify('new_game')
             return True
         else:
             return False
 
+    def _notify(self, event_type: str, **data):
+        self.version += 1
+        self.responses.invalidate(event_type)
+        self.events.publish({'event': event_type, 'version': self.version,
+                             'data': data})
+
+    def _notify_if_report_ready(self):
+        if len(self.issues_list) > 0 and self.is_report_ready():
+            self._notify('report', title=self.get_current_issue.title)
+            self._check_consensus()
+
+    def pop_consensus(self) -> Optional[Tuple[Tuple, Dict]]:
+        """
+        Returns the results key and results of the last issue that
+        reached consensus, once, so that they can be written even when
+        the game already moved to the next issue.
+        """
+        last_consensus, self.last_consensus = self.last_consensus, None
+        return last_consensus
+
+    @journaled
     def remove_player(self, user: User, username: str) -> Dict:
         if username == user.name:
             return {'result_message': ("Can't delete own user. Choose another "
@@ -151,6 +520,9 @@ class Game:
             print(f"{self.dealer} is removing {user.name}")
             if username in self.users:
                 del self.users[username]
+                self._track_voter(username, -1)
+                self._notify('user_removed', name=username)
+                self._notify_if_report_ready()
                 return {'result_message': f"Successfully removed {username}"}
             else:
                 return {'result_message': f"Couldn't find {username} as a "
@@ -160,35 +532,81 @@ class Game:
                                       f"can remove players. If there is no "
                                       f"dealer, please add one."}
 
+    @journaled
     def reset_votes(self, user: User) -> bool:
         if self.get_dealer and user.name == self.get_dealer:
-            crt_issue = self.get_current_initial_issue()
-            self.issues_list[self.current_issue_index] = \
-                Issue(**crt_issue.dict())
+            crt_issue = self.get_current_issue
+            self.issues_list[self.current_issue_index] = crt_issue.next_round()
+            self._notify('votes_reset', title=crt_issue.title)
             return True
         else:
             return False
 
+    @journaled
+    def set_consensus_policy(self, user: User,
+                             policy: ConsensusPolicy) -> bool:
+        if self.dealer and user.name == self.dealer:
+            self.consensus_policy = policy.dict()
+            self._notify('consensus_policy_changed', **self.consensus_policy)
+            return True
+        return False
+
+    @journaled
     def set_next_issue(self, user: User) -> int:
         if self.dealer and user.name == self.dealer and \
                 self.current_issue_index < len(self.issues_list) - 1:
             self.current_issue_index += 1
-            self.report_queue = Queue()
+            self._notify('issue_changed',
+                         title=self.get_current_issue.title)
         return self.current_issue_index
 
+    @journaled
     def set_previous_issue(self, user: User) -> int:
         if self.dealer and user.name == self.dealer and \
                 self.current_issue_index > 0:
             self.current_issue_index -= 1
-            self.report_queue = Queue()
+            self._notify('issue_changed',
+                         title=self.get_current_issue.title)
         return self.current_issue_index
 
+    @journaled
     def set_voting_system(self, voting_system: str):
         self.voting_system = VotingSystem[voting_system].value
+        self.card_indexes = self.get_card_indexes()
+        self._notify('voting_system_changed', voting_system=voting_system)
+
+    def _track_voter(self, username: str, change: int):
+        if self._voted_issue is not None and \
+                self._voted_issue.has_voted(username):
+            self._voted_count += change
 
     def show_users(self) -> Dict:
         return self.users
 
+    def to_snapshot(self) -> Dict:
+        return {
+            'room_id': self.room_id,
+            'room_uid': self.room_uid,
+            'games_started': self.games_started,
+            'game_id': self.game_id,
+            'voting_system': self.voting_system,
+            'next_issue_id': self.next_issue_id,
+            'issues': [{'issue_id': issue.issue_id,
+                        'title': issue.title,
+                        'description': issue.description,
+                        'round': issue.round,
+                        'votes': [[vote.name, vote.vote_value]
+                                  for vote in issue.votes],
+                        'consensus': issue.consensus}
+                       for issue in self.issues_list],
+            'users': [[user.name, user.is_dealer]
+                      for user in self.users.values()],
+            'dealer': self.dealer,
+            'current_issue_index': self.current_issue_index,
+            'consensus_policy': self.consensus_policy,
+            'version': self.version
+        }
+
     def validate_filename(self, filename: str) -> str:
         filename = re.sub(self.VALID_CHARS_PATTERN, " ", filename)
         return filename
@@ -197,8 +615,18 @@ class Game:
         username = re.sub(self.VALID_CHARS_PATTERN, " ", username)
         return username
 
+    @journaled
     def vote_issue(self, user_vote: UserVote):
-        if user_vote.name in self.left_to_vote():
-            self.issues_list[self.current_issue_index].votes.append(user_vote)
+        crt_issue = self.issues_list[self.current_issue_index]
+        if user_vote.name in self.users and \
+                not crt_issue.has_voted(user_vote.name):
+            crt_issue.add_vote(Vote(user_vote.name, user_vote.vote_value),
+                               self.get_vote_key(user_vote.vote_value),
+                               self.card_indexes.get(user_vote.vote_value))
+            if self._voted_issue is crt_issue:
+                self._voted_count += 1
+            self._notify('vote', name=user_vote.name,
+                         title=crt_issue.title)
+            self._notify_if_report_ready()
             return True
         return False
@@ -0,0 +1,138 @@
+import bisect
+import time
+
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+UNMATCHED_ROUTE = 'unmatched'
+
+
+def get_route_path(scope, route_paths: Dict[Callable, str]) -> str:
+    # the router adds the matched endpoint to the shared scope
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return UNMATCHED_ROUTE
+    if endpoint not in route_paths:
+        route_paths.update((route.endpoint, route.path)
+                           for route in scope['app'].routes
+                           if hasattr(route, 'endpoint'))
+    return route_paths.get(endpoint, UNMATCHED_ROUTE)
+
+
+class Histogram:
+    """
+    Latency histogram: each observation only bumps the bucket it falls
+    in, and the counts are made cumulative when rendered.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} '
+                         f'{cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """
+    Per-route request counters and latency histograms, rendered in the
+    Prometheus text format. Requests are only counted on the event
+    loop, so there is no locking; gauges are registered as callables
+    and evaluated when the metrics are scraped, not on the request
+    path.
+    """
+
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        self.latencies: Dict[Tuple[str, str], Histogram] = {}
+        self.gauges: Dict[str, Tuple[str, str, Callable]] = {}
+
+    def add_gauge(self, name: str, help_text: str,
+                  collect: Callable[[], Dict[str, float]],
+                  metric_type: str = 'gauge'):
+        # `collect` returns the values keyed by their rendered labels
+        self.gauges[name] = (help_text, metric_type, collect)
+
+    def observe_request(self, method: str, route: str, status_code: int,
+                        duration: float):
+        key = (method, route, status_code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.latencies.get((method, route))
+        if histogram is None:
+            histogram = self.latencies[(method, route)] = Histogram()
+        histogram.observe(duration)
+
+    def render(self) -> str:
+        lines = ['# HELP delta_requests_total Number of HTTP requests',
+                 '# TYPE delta_requests_total counter']
+        for (method, route, status_code), count in sorted(
+                self.requests.items()):
+            lines.append(f'delta_requests_total{{method="{method}",'
+                         f'route="{route}",status="{status_code}"}} {count}')
+        lines += ['# HELP delta_request_duration_seconds HTTP request '
+                  'latency',
+                  '# TYPE delta_request_duration_seconds histogram']
+        for (method, route), histogram in sorted(self.latencies.items()):
+            lines += histogram.render('delta_request_duration_seconds',
+                                      f'method="{method}",route="{route}"')
+        for name, (help_text, metric_type, collect) in self.gauges.items():
+            lines += [f'# HELP {name} {help_text}',
+                      f'# TYPE {name} {metric_type}']
+            for labels, value in collect().items():
+                lines.append(f'{name}{{{labels}}} {value}' if labels
+                             else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware, cheaper than a BaseHTTPMiddleware, that times
+    every HTTP request and labels it with the path of the matched route
+    rather than the raw URL, to keep the number of series bounded.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+        self.route_paths: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.observe_request(
+                scope['method'], get_route_path(scope, self.route_paths),
+                status_code, time.perf_counter() - start_time)
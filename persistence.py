@@ -0,0 +1,459 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from rooms import RoomRegistry
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+STATE_BACKEND = os.environ.get('DELTA_STATE_BACKEND', 'file')
+STATE_PATH = os.environ.get('DELTA_STATE_PATH', './state')
+SNAPSHOT_EVERY = int(os.environ.get('DELTA_SNAPSHOT_EVERY', 1000))
+WAL_FSYNC = os.environ.get('DELTA_WAL_FSYNC', '0') == '1'
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('DELTA_SQLITE_BUSY_TIMEOUT', 10))
+SYNC_INTERVAL = float(os.environ.get('DELTA_SYNC_INTERVAL', 0.05))
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Persists a RoomRegistry as a snapshot plus a write-ahead log. Every
+    journaled Game and registry operation is appended to the log, and
+    after `snapshot_every` operations the whole registry is written to
+    a new snapshot and the log is truncated, which bounds how much of
+    the log a restart has to replay.
+
+    The registry is copied and the log rotated to `wal.jsonl.prev` on
+    the event loop, which owns them, and the copy is written from the
+    default executor, which then deletes the rotated log. Until it does,
+    a restart replays both logs on top of the previous snapshot.
+    """
+
+    def __init__(self, registry: RoomRegistry, path: str = STATE_PATH,
+                 snapshot_every: int = SNAPSHOT_EVERY,
+                 fsync: bool = WAL_FSYNC):
+        self.registry = registry
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.seq = 0
+        self.ops_since_snapshot = 0
+        self.wal_file = None
+        self.snapshot_seq = 0
+        self.snapshot_lock = threading.RLock()
+        self.pending_snapshot: Optional[asyncio.Future] = None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.path, 'snapshot.json')
+
+    @property
+    def wal_path(self) -> str:
+        return os.path.join(self.path, 'wal.jsonl')
+
+    @property
+    def previous_wal_path(self) -> str:
+        return f"{self.wal_path}.prev"
+
+    def append(self, room_id: str, op: str, args: Dict):
+        self.seq += 1
+        self.wal_file.write(json.dumps({'seq': self.seq, 'room_id': room_id,
+                                        'op': op, 'args': args}) + '\n')
+        self.wal_file.flush()
+        if self.fsync:
+            os.fsync(self.wal_file.fileno())
+        self.ops_since_snapshot += 1
+        # a single snapshot is written at a time, and a rotated log left
+        # by a failed one is only dropped by the next blocking snapshot
+        if self.ops_since_snapshot >= self.snapshot_every and \
+                self.pending_snapshot is None and \
+                not os.path.exists(self.previous_wal_path):
+            self.start_snapshot()
+
+    def close(self):
+        if self.wal_file is None:
+            return
+        self.snapshot()
+        self.registry.set_journal(None)
+        self.wal_file.close()
+        self.wal_file = None
+
+    @property
+    def shared(self) -> bool:
+        return False
+
+    def recover(self) -> int:
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self.registry.restore(snapshot['rooms'])
+            self.snapshot_seq = self.seq = snapshot['seq']
+
+        replayed = 0
+        # the rotated log holds the operations of a snapshot that may not
+        # have been saved, and comes before the current one
+        for wal_path in (self.previous_wal_path, self.wal_path):
+            if os.path.exists(wal_path):
+                replayed += self.replay(wal_path)
+
+        self.ops_since_snapshot = replayed
+        self.wal_file = open(self.wal_path, 'a')
+        self.registry.set_journal(self.append)
+        if not os.path.exists(self.snapshot_path) or \
+                os.path.exists(self.previous_wal_path):
+            self.snapshot()
+        return replayed
+
+    def replay(self, wal_path: str) -> int:
+        replayed = 0
+        valid_size = 0
+        with open(wal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    logger.warning(f"Found a partial record at the end "
+                                   f"of {wal_path}, dropping it")
+                    break
+                valid_size += len(line)
+                if record['seq'] <= self.snapshot_seq:
+                    continue
+                try:
+                    self.registry.apply(record['room_id'], record['op'],
+                                        record['args'])
+                except Exception as e:
+                    logger.error(f"Couldn't replay {record}: {e}")
+                self.seq = record['seq']
+                replayed += 1
+        with open(wal_path, 'r+b') as f:
+            f.truncate(valid_size)
+        return replayed
+
+    async def sync(self) -> int:
+        # a single process owns the files, so there is nothing to catch up
+        return 0
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        yield
+
+    def save_snapshot(self, seq: int, rooms: Dict):
+        try:
+            self.write_snapshot(seq, rooms)
+        except Exception:
+            logger.exception(f"Couldn't save the snapshot at {seq}")
+
+    def snapshot(self):
+        # blocking, for recovery, shutdown and callers without a loop
+        with self.snapshot_lock:
+            self.write_snapshot(self.seq, self.registry.to_snapshot())
+            self.wal_file.close()
+            self.wal_file = open(self.wal_path, 'w')
+        self.ops_since_snapshot = 0
+
+    def snapshot_done(self, _):
+        self.pending_snapshot = None
+
+    def start_snapshot(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.snapshot()
+            return
+        rooms = self.registry.to_snapshot()
+        self.wal_file.close()
+        os.replace(self.wal_path, self.previous_wal_path)
+        self.wal_file = open(self.wal_path, 'a')
+        self.ops_since_snapshot = 0
+        self.pending_snapshot = loop.run_in_executor(
+            None, self.save_snapshot, self.seq, rooms)
+        self.pending_snapshot.add_done_callback(self.snapshot_done)
+
+    def write_snapshot(self, seq: int, rooms: Dict):
+        with self.snapshot_lock:
+            if seq < self.snapshot_seq:
+                # a blocking snapshot got ahead of this one
+                return
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'seq': seq, 'rooms': rooms}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            self.snapshot_seq = seq
+            if os.path.exists(self.previous_wal_path):
+                os.remove(self.previous_wal_path)
+
+
+class SQLiteStateStore:
+    """
+    Shares a RoomRegistry between worker processes through a SQLite
+    database in WAL mode, so readers never block the writer. Journaled
+    operations are rows of an `ops` table, numbered by `seq`. A worker
+    mutates a room inside `transaction()`, which takes the database
+    write lock and first applies the operations of the other workers,
+    so every worker applies the same operations in the same order; it
+    also catches up with `sync()` before serving a request.
+
+    Nothing waits on the event loop: the write lock is tried without a
+    busy timeout and retried after an async sleep, and `sync()` reads
+    new operations in the default executor, sharing one read between
+    concurrent requests. Only the operations themselves are applied on
+    the loop, which owns the registry.
+
+    Every `snapshot_every` operations the registry is copied and saved
+    to the `snapshots` table from the executor, and the operations
+    before the previous snapshot are deleted, so a worker that lags
+    behind by less than a snapshot interval still finds every operation
+    it missed; one that doesn't reloads the latest snapshot.
+    """
+
+    def __init__(self, registry: RoomRegistry, path: str = STATE_PATH,
+                 snapshot_every: int = SNAPSHOT_EVERY,
+                 fsync: bool = WAL_FSYNC,
+                 busy_timeout: float = SQLITE_BUSY_TIMEOUT):
+        self.registry = registry
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.busy_timeout = busy_timeout
+        self.seq = 0
+        self.connection = None
+        self.reader = None
+        self.in_transaction = False
+        self.replaying = False
+        self.pending_read: Optional[asyncio.Future] = None
+
+    @property
+    def db_path(self) -> str:
+        return os.path.join(self.path, 'state.db')
+
+    @property
+    def shared(self) -> bool:
+        return True
+
+    def append(self, room_id: str, op: str, args: Dict):
+        if self.replaying:
+            return
+        if not self.in_transaction:
+            # the operation was applied without catching up first, so it
+            # still gets the next seq, but may have seen a stale room
+            logger.warning(f"Journaled '{op}' on room '{room_id}' outside "
+                           f"of a transaction")
+            with self.blocking_transaction():
+                self.append(room_id, op, args)
+            return
+        self.seq += 1
+        self.connection.execute(
+            'INSERT INTO ops (seq, room_id, op, args) VALUES (?, ?, ?, ?)',
+            (self.seq, room_id, op, json.dumps(args)))
+        if self.seq % self.snapshot_every == 0:
+            rooms = self.registry.to_snapshot()
+            asyncio.get_event_loop().run_in_executor(
+                None, self.save_snapshot, self.seq, rooms)
+
+    def apply_ops(self, rows: List[Tuple]) -> int:
+        rows = [row for row in rows if row[0] > self.seq]
+        if rows and rows[0][0] != self.seq + 1:
+            logger.warning(f"Operations after {self.seq} were already "
+                           f"deleted, reloading the latest snapshot")
+            self.load_snapshot()
+            rows = [row for row in rows if row[0] > self.seq]
+        self.replaying = True
+        try:
+            for seq, room_id, op, args in rows:
+                try:
+                    self.registry.apply(room_id, op, json.loads(args))
+                except Exception as e:
+                    logger.error(f"Couldn't apply operation {seq} "
+                                 f"'{op}' on room '{room_id}': {e}")
+                self.seq = seq
+        finally:
+            self.replaying = False
+        return len(rows)
+
+    def begin(self) -> bool:
+        if self.in_transaction:
+            # another request of this worker holds the lock
+            return False
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+            return True
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                return False
+            raise
+
+    @contextlib.contextmanager
+    def blocking_transaction(self) -> Iterator[None]:
+        # for recovery, shutdown and stray operations, off the request path
+        if self.in_transaction:
+            yield
+            return
+        self.connection.execute(
+            f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        finally:
+            self.connection.execute('PRAGMA busy_timeout = 0')
+        with self.locked():
+            yield
+
+    def catch_up(self) -> int:
+        return self.apply_ops(self.read_ops(self.connection, self.seq))
+
+    def close(self):
+        if self.connection is None:
+            return
+        with self.blocking_transaction():
+            self.snapshot()
+        self.registry.set_journal(None)
+        self.connection.close()
+        self.reader.close()
+        self.connection = None
+        self.reader = None
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(self.path, exist_ok=True)
+        # transactions are begun explicitly, see transaction()
+        connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        connection.execute('CREATE TABLE IF NOT EXISTS ops ('
+                           'seq INTEGER PRIMARY KEY, room_id TEXT NOT NULL, '
+                           'op TEXT NOT NULL, args TEXT NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                           'seq INTEGER PRIMARY KEY, rooms TEXT NOT NULL)')
+        return connection
+
+    def load_snapshot(self) -> bool:
+        row = self.connection.execute(
+            'SELECT seq, rooms FROM snapshots ORDER BY seq DESC '
+            'LIMIT 1').fetchone()
+        if row is None:
+            return False
+        self.registry.restore(json.loads(row[1]))
+        self.registry.set_journal(self.append)
+        self.seq = row[0]
+        return True
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[None]:
+        # holding the write lock: catch up, run the body and commit
+        self.in_transaction = True
+        try:
+            self.catch_up()
+            yield
+        finally:
+            # operations appended before an error were applied to the
+            # registry already, so they are committed rather than lost
+            self.in_transaction = False
+            self.connection.execute('COMMIT')
+
+    @staticmethod
+    def read_ops(connection: sqlite3.Connection, after_seq: int
+                 ) -> List[Tuple]:
+        return connection.execute(
+            'SELECT seq, room_id, op, args FROM ops WHERE seq > ? '
+            'ORDER BY seq', (after_seq,)).fetchall()
+
+    def recover(self) -> int:
+        self.connection = self.connect()
+        self.reader = self.connect()
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.in_transaction = True
+        try:
+            if not self.load_snapshot():
+                # the first worker's registry, with its default room,
+                # becomes the state every other worker starts from
+                self.snapshot()
+            replayed = self.catch_up()
+        finally:
+            self.in_transaction = False
+            self.connection.execute('COMMIT')
+        # the write lock is only ever tried, see transaction()
+        self.connection.execute('PRAGMA busy_timeout = 0')
+        self.registry.set_journal(self.append)
+        return replayed
+
+    def save_snapshot(self, seq: int, rooms: Dict):
+        connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout,
+                                     isolation_level=None)
+        try:
+            data = json.dumps(rooms)
+            connection.execute('BEGIN IMMEDIATE')
+            self.write_snapshot(connection, seq, data)
+            connection.execute('COMMIT')
+        except Exception:
+            logger.exception(f"Couldn't save the snapshot at {seq}")
+        finally:
+            connection.close()
+
+    def snapshot(self):
+        self.write_snapshot(self.connection, self.seq,
+                            json.dumps(self.registry.to_snapshot()))
+
+    async def sync(self) -> int:
+        if self.pending_read is None:
+            self.pending_read = asyncio.get_event_loop().run_in_executor(
+                None, self.read_ops, self.reader, self.seq)
+            self.pending_read.add_done_callback(self.read_done)
+        rows = await asyncio.shield(self.pending_read)
+        # the requests sharing the read apply the operations only once
+        return self.apply_ops(rows)
+
+    def read_done(self, _):
+        self.pending_read = None
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        deadline = time.monotonic() + self.busy_timeout
+        delay = 0.001
+        while not self.begin():
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Couldn't lock {self.db_path} in "
+                                   f"{self.busy_timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 0.05)
+        with self.locked():
+            yield
+
+    @staticmethod
+    def write_snapshot(connection: sqlite3.Connection, seq: int,
+                       data: str):
+        connection.execute(
+            'INSERT OR REPLACE INTO snapshots (seq, rooms) VALUES (?, ?)',
+            (seq, data))
+        previous = connection.execute(
+            'SELECT MAX(seq) FROM snapshots WHERE seq < ?',
+            (seq,)).fetchone()[0]
+        if previous is not None:
+            connection.execute('DELETE FROM ops WHERE seq <= ?', (previous,))
+            connection.execute('DELETE FROM snapshots WHERE seq < ?',
+                               (previous,))
+
+
+def create_state_store(registry: RoomRegistry,
+                       backend: str = STATE_BACKEND
+                       ) -> Union[StateStore, SQLiteStateStore]:
+    if backend == 'file':
+        return StateStore(registry)
+    if backend == 'sqlite':
+        return SQLiteStateStore(registry)
+    raise ValueError(f"Unknown state backend '{backend}', "
+                     f"expected 'file' or 'sqlite'")
@@ -0,0 +1,133 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import time
+
+from metrics import get_route_path
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import parse_qs
+
+PROFILE_PATH = os.environ.get('DELTA_PROFILE_PATH', './profiles')
+PROFILE_SAMPLE_RATE = float(os.environ.get('DELTA_PROFILE_SAMPLE_RATE', 0))
+SLOW_REQUEST_SECONDS = float(os.environ.get('DELTA_SLOW_REQUEST_SECONDS', 0))
+PROFILE_SUFFIX = '.prof'
+# routes that hold the connection open, so their duration is not slowness
+STREAMING_PATHS = ('/game/events',)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfiler:
+    """
+    Profiles HTTP requests with cProfile and saves the profiles of a
+    random `sample_rate` fraction of them and of every request slower
+    than `slow_request_seconds`. A threshold means every request has to
+    run under the profiler, since slowness is only known at the end.
+
+    cProfile follows a single thread, and every request shares the
+    event loop's, so only one request is profiled at a time and its
+    profile also holds whatever else the loop ran meanwhile. A slow
+    request that overlapped a profiled one is only logged.
+    """
+
+    def __init__(self, path: str = PROFILE_PATH,
+                 sample_rate: float = PROFILE_SAMPLE_RATE,
+                 slow_request_seconds: float = SLOW_REQUEST_SECONDS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_request_seconds = slow_request_seconds
+        self.profiling = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_request_seconds > 0
+
+    def is_slow(self, duration: float) -> bool:
+        return 0 < self.slow_request_seconds <= duration
+
+    def list_profiles(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted((name for name in os.listdir(self.path)
+                       if name.endswith(PROFILE_SUFFIX)), reverse=True)
+
+    def read_profile(self, name: str, sort_by: str = 'cumulative',
+                     limit: int = 50) -> Optional[str]:
+        if name not in self.list_profiles():
+            return None
+        stream = io.StringIO()
+        stats = pstats.Stats(os.path.join(self.path, name), stream=stream)
+        stats.sort_stats(sort_by).print_stats(limit)
+        return stream.getvalue()
+
+    def save(self, profiler: cProfile.Profile, method: str, route: str,
+             duration: float) -> str:
+        os.makedirs(self.path, exist_ok=True)
+        route_name = re.sub(r"[^a-zA-Z0-9]+", "_", route).strip('_')
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}_{method}_{route_name}_"
+                f"{duration * 1000:.0f}ms{PROFILE_SUFFIX}")
+        profiler.dump_stats(os.path.join(self.path, name))
+        return name
+
+
+def is_held_open(scope) -> bool:
+    """
+    Tells whether a request streams events or long-polls (`wait` > 0),
+    i.e. whether it stays open by design.
+    """
+    if scope['path'] in STREAMING_PATHS:
+        return True
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        return float(query.get('wait', ['0'])[0]) > 0
+    except ValueError:
+        return False
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+        self.route_paths: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or is_held_open(scope):
+            await self.app(scope, receive, send)
+            return
+
+        sampled = random.random() < self.profiler.sample_rate
+        profiler = None
+        if (sampled or self.profiler.slow_request_seconds > 0) and \
+                not self.profiler.profiling:
+            self.profiler.profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            duration = time.perf_counter() - start_time
+            if profiler is not None:
+                profiler.disable()
+                self.profiler.profiling = False
+            route = get_route_path(scope, self.route_paths)
+            slow = self.profiler.is_slow(duration)
+            if slow:
+                logger.warning(f"Slow request: {scope['method']} {route} "
+                               f"took {duration:.3f}s")
+            if profiler is not None and (sampled or slow):
+                try:
+                    self.profiler.save(profiler, scope['method'], route,
+                                       duration)
+                except OSError as e:
+                    logger.error(f"Couldn't save the profile of "
+                                 f"{scope['method']} {route}: {e}")
@@ -0,0 +1,41 @@
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+
+class ResponseCache:
+    """
+    Encoded response bodies of a game's read endpoints. Each entry
+    names the game events that change it, so an event only drops the
+    entries it affects; an entry without events is dropped by all of
+    them. It is only touched from the event loop.
+
+    Since a miss is built and stored before the loop serves another
+    request, concurrent identical reads of the same game state are
+    computed once and the others are hits.
+    """
+
+    def __init__(self):
+        self.entries: Dict[str, Tuple[bytes, Optional[frozenset]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def invalidate(self, event_type: str):
+        stale_keys = [key for key, (_, events) in self.entries.items()
+                      if events is None or event_type in events]
+        for key in stale_keys:
+            del self.entries[key]
+
+    def set(self, key: str, body: bytes,
+            events: Optional[Iterable[str]] = None):
+        self.entries[key] = (body, frozenset(events)
+                             if events is not None else None)
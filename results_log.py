@@ -0,0 +1,236 @@
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import threading
+
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+RESULTS_PATH = os.environ.get('DELTA_RESULTS_PATH', './results')
+SEGMENT_PREFIX = 'segment_'
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsLog:
+    """
+    Append-only log of issue results, split in JSONL segments. Next to
+    every segment, an index file keeps the offset and length of each
+    record, keyed by room, issue and round, so an issue's history is
+    read straight from memory-mapped segments without scanning them.
+    Subscribers get every record already in the log and then every
+    appended batch.
+
+    Several worker processes can share the log: appends hold an
+    exclusive lock on a lock file, and each process reads the index
+    entries appended by the others incrementally, before appending and
+    before reading. Every worker may submit the same result, so a
+    record whose room, game, issue, round and vote count are already in
+    the log is dropped.
+    """
+
+    def __init__(self, path: str = RESULTS_PATH,
+                 max_segment_size: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_segment_size = max_segment_size
+        self.index: Dict[Tuple[str, str], List[Tuple]] = {}
+        self.segment_number = 1
+        self.mmaps: Dict[int, mmap.mmap] = {}
+        # bytes of each index file already added to the index
+        self.index_offsets: Dict[str, int] = {}
+        self.record_keys = set()
+        # reentrant, since append and history refresh the index first
+        self.lock = threading.RLock()
+        self.subscribers: List[Callable[[List[Dict]], None]] = []
+        self.refresh()
+
+    def add_to_index(self, segment_number: int, index_entry: Dict):
+        key = (index_entry['room_id'], index_entry['title'])
+        self.index.setdefault(key, []).append(
+            (index_entry['round'], index_entry.get('issue_id'),
+             segment_number, index_entry['offset'], index_entry['length']))
+        self.record_keys.add(self.get_record_key(index_entry))
+
+    def append(self, records: List[Dict]) -> int:
+        """
+        Appends the records that aren't in the log yet and returns how
+        many were written.
+        """
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.lock_path, 'a') as lock_file:
+                # released when the lock file is closed
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.refresh()
+                return self.write(records)
+
+    def write(self, records: List[Dict]) -> int:
+        segment_path = self.segment_path(self.segment_number)
+        offset = os.path.getsize(segment_path) \
+            if os.path.exists(segment_path) else 0
+        data_lines, index_lines, entries, new_records = [], [], [], []
+        new_keys = set()
+        for record in records:
+            index_entry = {'room_id': record['room_id'],
+                           'game_id': record.get('game_id'),
+                           'issue_id': record.get('issue_id'),
+                           'title': record['title'],
+                           'round': record['round'],
+                           'votes': sum(vote_details['vote_count']
+                                        for vote_details in
+                                        record['report'].values())}
+            record_key = self.get_record_key(index_entry)
+            if record_key in self.record_keys or record_key in new_keys:
+                continue
+            new_keys.add(record_key)
+            line = (json.dumps(record) + '\n').encode()
+            index_entry['offset'] = offset
+            index_entry['length'] = len(line)
+            data_lines.append(line)
+            index_lines.append(json.dumps(index_entry) + '\n')
+            entries.append(index_entry)
+            new_records.append(record)
+            offset += len(line)
+        if not new_records:
+            return 0
+        with open(segment_path, 'ab') as f:
+            f.write(b''.join(data_lines))
+        index_path = self.index_path(self.segment_number)
+        with open(index_path, 'a') as f:
+            f.write(''.join(index_lines))
+        self.index_offsets[index_path] = os.path.getsize(index_path)
+        for index_entry in entries:
+            self.add_to_index(self.segment_number, index_entry)
+        if offset >= self.max_segment_size:
+            self.segment_number += 1
+        self.notify(new_records)
+        return len(new_records)
+
+    @staticmethod
+    def get_record_key(index_entry: Dict) -> Tuple:
+        # entries written before vote counts were indexed never match
+        votes = index_entry['votes'] if 'votes' in index_entry \
+            else ('offset', index_entry['offset'])
+        # issues share titles, so the id tells them apart when recorded
+        issue = index_entry.get('issue_id') or index_entry['title']
+        return (index_entry['room_id'], index_entry.get('game_id'), issue,
+                index_entry['round'], votes)
+
+    def get_mmap(self, segment_number: int, min_size: int) -> mmap.mmap:
+        segment = self.mmaps.get(segment_number)
+        if segment is None or len(segment) < min_size:
+            if segment is not None:
+                segment.close()
+            with open(self.segment_path(segment_number), 'rb') as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmaps[segment_number] = segment
+        return segment
+
+    def history(self, room_id: str, title: str,
+                issue_round: Optional[int] = None,
+                issue_id: Optional[int] = None) -> List[Dict]:
+        with self.lock:
+            self.refresh()
+            entries = list(self.index.get((room_id, title), []))
+            records = []
+            for crt_round, crt_issue_id, segment_number, offset, length \
+                    in entries:
+                if issue_round is not None and crt_round != issue_round:
+                    continue
+                if issue_id is not None and crt_issue_id != issue_id:
+                    continue
+                segment = self.get_mmap(segment_number, offset + length)
+                records.append(json.loads(segment[offset:offset + length]))
+            return records
+
+    def index_path(self, segment_number: int) -> str:
+        return os.path.join(self.path,
+                            f"{SEGMENT_PREFIX}{segment_number:06d}.idx")
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.path, 'results.lock')
+
+    def notify(self, records: List[Dict]):
+        for subscriber in self.subscribers:
+            try:
+                subscriber(records)
+            except Exception:
+                logger.exception(f"Couldn't pass {len(records)} results "
+                                 f"to a subscriber")
+
+    def refresh(self):
+        """
+        Adds the index entries appended since the last refresh, by this
+        or another process, and passes their records to the subscribers.
+        """
+        with self.lock:
+            index_paths = sorted(glob.glob(
+                os.path.join(self.path, f"{SEGMENT_PREFIX}*.idx")))
+            new_entries = []
+            for index_path in index_paths:
+                segment_number = int(os.path.basename(index_path)
+                                     [len(SEGMENT_PREFIX):-len('.idx')])
+                self.segment_number = max(self.segment_number, segment_number)
+                offset = self.index_offsets.get(index_path, 0)
+                if os.path.getsize(index_path) <= offset:
+                    continue
+                with open(index_path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                # a line still being written is read on the next refresh
+                data = data[:data.rfind(b'\n') + 1]
+                self.index_offsets[index_path] = offset + len(data)
+                for line in data.splitlines():
+                    try:
+                        index_entry = json.loads(line)
+                        self.add_to_index(segment_number, index_entry)
+                    except (json.decoder.JSONDecodeError, KeyError) as e:
+                        logger.warning(f"Skipped a damaged entry in "
+                                       f"{index_path}: {e}")
+                        continue
+                    new_entries.append((segment_number, index_entry))
+            segment_path = self.segment_path(self.segment_number)
+            if os.path.exists(segment_path) and \
+                    os.path.getsize(segment_path) >= self.max_segment_size:
+                self.segment_number += 1
+            if self.subscribers and new_entries:
+                records = []
+                for segment_number, index_entry in new_entries:
+                    offset = index_entry['offset']
+                    length = index_entry['length']
+                    segment = self.get_mmap(segment_number, offset + length)
+                    records.append(json.loads(segment[offset:offset + length]))
+                self.notify(records)
+
+    def read_segment(self, segment_path: str) -> List[Dict]:
+        records = []
+        with open(segment_path, 'rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.decoder.JSONDecodeError as e:
+                    logger.warning(f"Skipped a damaged record in "
+                                   f"{segment_path}: {e}")
+        return records
+
+    def segment_path(self, segment_number: int) -> str:
+        return os.path.join(self.path,
+                            f"{SEGMENT_PREFIX}{segment_number:06d}.jsonl")
+
+    def subscribe(self, subscriber: Callable[[List[Dict]], None]):
+        with self.lock:
+            if subscriber in self.subscribers:
+                return
+            self.refresh()
+            segment_paths = sorted(glob.glob(
+                os.path.join(self.path, f"{SEGMENT_PREFIX}*.jsonl")))
+            for segment_path in segment_paths:
+                subscriber(self.read_segment(segment_path))
+            self.subscribers.append(subscriber)
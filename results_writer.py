@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from results_log import ResultsLog
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsWriter:
+    """
+    Writes issue results from a background task, so that requests only
+    enqueue a record. Records are appended to the results log in
+    batches, in the default executor, and a record whose key was
+    already submitted (i.e. the same game, issue, round and votes) is
+    dropped.
+    """
+
+    def __init__(self, results_log: ResultsLog, max_queue_size: int = 1000,
+                 batch_size: int = 50, max_seen_keys: int = 10000):
+        self.results_log = results_log
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.max_seen_keys = max_seen_keys
+        self.queue: Optional[asyncio.Queue] = None
+        self.seen_keys = OrderedDict()
+        self.records_written = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+
+    def submit(self, key: Hashable, record: Dict) -> bool:
+        if key in self.seen_keys:
+            return False
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            logger.error(f"Results queue is full, dropped results for "
+                         f"'{record['title']}'")
+            return False
+        self.seen_keys[key] = None
+        if len(self.seen_keys) > self.max_seen_keys:
+            self.seen_keys.popitem(last=False)
+        return True
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await loop.run_in_executor(None, self.flush, batch)
+            except Exception:
+                logger.exception(f"Couldn't write a batch of {len(batch)} "
+                                 f"results")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, batch: List[Dict]):
+        # records another worker already wrote are dropped by the log
+        self.records_written += self.results_log.append(batch)
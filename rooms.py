@@ -0,0 +1,83 @@
+import uuid
+
+from game import Game
+from game import VotingSystem
+from pydantic import BaseModel
+from pydantic import constr
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+DEFAULT_ROOM_ID = 'default'
+
+
+class Room(BaseModel):
+    room_id: constr(min_length=1, max_length=64, regex=r"^[a-zA-Z0-9_-]+$")
+    voting_system: Optional[str] = 'fibonacci'
+
+
+class RoomRegistry:
+    """
+    Keeps every running game, keyed by room id. The registry is only
+    touched from the event loop, and each Game carries its own lock,
+    so traffic in one room never waits on another room.
+    """
+
+    def __init__(self):
+        self.rooms: Dict[str, Game] = {}
+        self.journal: Optional[Callable[[str, str, Dict], None]] = None
+        self.add_room(DEFAULT_ROOM_ID)
+
+    def add_room(self, room_id: str, voting_system: str = 'fibonacci',
+                 room_uid: Optional[str] = None) -> bool:
+        if room_id in self.rooms:
+            return False
+        game = Game(VotingSystem[voting_system].value, room_id=room_id,
+                    room_uid=room_uid or uuid.uuid4().hex)
+        game.journal = self.journal
+        self.rooms[room_id] = game
+        if self.journal is not None:
+            self.journal(room_id, 'add_room',
+                         {'voting_system': voting_system,
+                          'room_uid': game.room_uid})
+        return True
+
+    def apply(self, room_id: str, op: str, args: Dict):
+        if op == 'add_room':
+            self.add_room(room_id, **args)
+        elif op == 'remove_room':
+            self.remove_room(room_id)
+        else:
+            self.rooms[room_id].apply(op, args)
+
+    def get_room(self, room_id: str) -> Optional[Game]:
+        return self.rooms.get(room_id)
+
+    def remove_room(self, room_id: str) -> bool:
+        if room_id == DEFAULT_ROOM_ID:
+            return False
+        removed = self.rooms.pop(room_id, None) is not None
+        if removed and self.journal is not None:
+            self.journal(room_id, 'remove_room', {})
+        return removed
+
+    def restore(self, snapshot: Dict):
+        replaced_rooms = self.rooms
+        self.rooms = {room_id: Game.from_snapshot(game_snapshot)
+                      for room_id, game_snapshot in snapshot.items()}
+        # streams and long polls still follow the replaced games
+        for game in replaced_rooms.values():
+            game.events.close()
+
+    def set_journal(self, journal: Optional[Callable[[str, str, Dict], None]]):
+        self.journal = journal
+        for game in self.rooms.values():
+            game.journal = journal
+
+    def show_rooms(self) -> List[str]:
+        return list(self.rooms.keys())
+
+    def to_snapshot(self) -> Dict:
+        return {room_id: game.to_snapshot()
+                for room_id, game in self.rooms.items()}
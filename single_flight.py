@@ -0,0 +1,42 @@
+import asyncio
+import functools
+
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import List
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call runs in the
+    default executor, callers with the same name and key await its
+    result instead of running it again. Nothing is kept once the call
+    completes, so only overlapping calls share work, and the key has
+    to name the state the call reads.
+
+    The shared call runs in its own task, so a caller that goes away
+    doesn't cancel it for the others. It is only touched from the event
+    loop.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        # calls and shared (coalesced) calls per name
+        self.counts: Dict[str, List[int]] = {}
+
+    async def run(self, name: str, key: Hashable, func: Callable, *args):
+        counts = self.counts.setdefault(name, [0, 0])
+        counts[0] += 1
+        call_key = (name, key)
+        future = self.calls.get(call_key)
+        if future is not None:
+            counts[1] += 1
+        else:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(None, functools.partial(func,
+                                                                  *args))
+            self.calls[call_key] = future
+            future.add_done_callback(
+                lambda _: self.calls.pop(call_key, None))
+        return await asyncio.shield(future)